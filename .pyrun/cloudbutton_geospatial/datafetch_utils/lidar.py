@@ -9,58 +9,112 @@ DATE: 11/02/2019
 """
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 
 LIDAR_IDS_DOC = 'lidar_ids_doc.txt'
+CNIG_URL = 'http://centrodedescargas.cnig.es/CentroDescargas'
+CHUNK_SIZE = 1024 * 1024
 
 
-def fetch_doc_list(state_cod, lidar_data_dir, whole_spain='N', lidar_ids_file=LIDAR_IDS_DOC):
+def create_session(pool_size=16, retries=3):
+    """
+    Crea una sesión HTTP que reutiliza las conexiones entre peticiones.
+
+    :param pool_size: Número máximo de conexiones abiertas, al menos el número de hilos
+    :param retries: Reintentos de los errores de conexión
+    """
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def parse_doc_page(text):
+    """
+    Extrae de una página de resultados el nombre y el identificador del enlace
+    de descarga de cada fichero, e indica si hay una página siguiente.
+
+    :param text: HTML de la página de resultados
+    """
+
+    soup = BeautifulSoup(text, 'lxml')
+    next_link = soup.find('a', {'title': 'Siguiente'})
+    doc_list = []
+    file_list_div = soup.find('div', {'id': 'blqListaArchivos'})
+    file_list_tb = file_list_div.find('table').find('tbody') if file_list_div else None
+    trs = file_list_tb.find_all('tr') if file_list_tb else []
+    for tr in trs:
+        ihidden = tr.find_all('input', {'type': 'hidden'})
+        file_link_id = None
+        for input in ihidden:
+            if input['id'].startswith('secGeo_'):
+                file_link_id = input['value']
+        file_name = tr.find('td', {'data-th': 'Nombre'}).text
+        doc_list.append((file_name, file_link_id))
+    return doc_list, next_link is not None
+
+
+def fetch_doc_list(state_cod, lidar_data_dir, whole_spain='N', lidar_ids_file=LIDAR_IDS_DOC,
+                   session=None, workers=8, base_url=CNIG_URL):
     """
     Recupera el nombre y el identificador del enlace de descarga de todos los
     ficheros LIDAR de una provincia entera.
 
+    Las páginas se piden en lotes de workers páginas concurrentes hasta llegar
+    a la última.
+
     :param state_cod: Código de provincia
     :param lidar_data_dir: Dir where to store the lidar files
     :param whole_spain: Indica si es para toda España
     :param lidar_ids_file: Nombre del fichero en el que almacenar los identificadores de los ficheros LIDAR
+    :param session: Sesión HTTP a utilizar, se crea una si no se indica
+    :param workers: Número de páginas pedidas a la vez
+    :param base_url: URL del centro de descargas
 
     """
 
-    url = 'http://centrodedescargas.cnig.es/CentroDescargas/resultadosArchivos'
-    next_page = 1
-    doc_list = []
-    while next_page:
-        print('Leyendo documentos de la página {}'.format(next_page))
+    session = session or create_session(workers)
+    url = '{}/resultadosArchivos'.format(base_url)
+
+    def fetch_page(page):
+        print('Leyendo documentos de la página {}'.format(page))
         data = {
-            'numPagina': next_page,
+            'numPagina': page,
             'codSerie': 'LIDA2',
             'series': 'LIDA2',
             'codProvAv': state_cod,
             'todaEsp': whole_spain,
             'tipoBusqueda': 'AV',
         }
-        response = requests.post(url, data=data)
+        response = session.post(url, data=data)
         if response.status_code != 200:
-            print('>>>>> Error. No se pudo recuperar el listado de documentos')
-            print(response.text)
-            return
-        data = response.text
-        soup = BeautifulSoup(data, 'lxml')
-        next_link = soup.find('a', {'title': 'Siguiente'})
-        next_page = next_page + 1 if next_link else None
-        file_list_div = soup.find('div', {'id': 'blqListaArchivos'})
-        file_list_tb = file_list_div.find('table').find('tbody')
-        trs = file_list_tb.find_all('tr')
-        for tr in trs:
-            ihidden = tr.find_all('input', {'type': 'hidden'})
-            file_link_id = None
-            for input in ihidden:
-                if input['id'].startswith('secGeo_'):
-                    file_link_id = input['value']
-            file_name = tr.find('td', {'data-th': 'Nombre'}).text
-            doc_list.append((file_name, file_link_id))
+            return None, response.text
+        return parse_doc_page(response.text), None
+
+    doc_list = []
+    first_page = 1
+    last_page = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while last_page is None:
+            pages = range(first_page, first_page + workers)
+            # Pages past the last one are discarded
+            for page, (result, error) in zip(pages, executor.map(fetch_page, pages)):
+                if result is None:
+                    print('>>>>> Error. No se pudo recuperar el listado de documentos')
+                    print(error)
+                    return
+                page_docs, has_next = result
+                doc_list.extend(page_docs)
+                if not has_next:
+                    last_page = page
+                    break
+            first_page += workers
     print('Número de docs: {}'.format(len(doc_list)))
 
     # Save a file with all file links
@@ -68,46 +122,91 @@ def fetch_doc_list(state_cod, lidar_data_dir, whole_spain='N', lidar_ids_file=LI
     with open(lidar_doc_file_path, 'w') as lidar_docs_file:
         for doc in doc_list:
             lidar_docs_file.write('{},{}\n'.format(doc[0], doc[1]))
+    return doc_list
 
 
-def download_file(file_name, sec_desc_dir_la, lidar_data_dir):
+def download_file(file_name, sec_desc_dir_la, lidar_data_dir, session=None, base_url=CNIG_URL):
     """
     Realiza la descarga de un fichero LIDAR a partir del id del enlace de descarga.
 
-    NOTA: Esto se podría ejecutar en paralelo
+    El contenido se escribe por bloques en un fichero .part que se renombra al
+    terminar. Los ficheros ya descargados no se vuelven a pedir y las descargas
+    interrumpidas se reanudan si el servidor admite peticiones parciales.
 
     :param file_name: Nombre que se le dará al fichero a descargar
     :param sec_desc_dir_la: Id del enlace de descarga
+    :param lidar_data_dir: Dir where to store the lidar files
+    :param session: Sesión HTTP a utilizar
+    :param base_url: URL del centro de descargas
     """
 
+    file_path = os.path.join(lidar_data_dir, file_name)
+    if os.path.exists(file_path):
+        print('{} - Fichero {} ya descargado'.format(sec_desc_dir_la, file_name))
+        return file_path
+
     print('{} - Leyendo fichero {}'.format(sec_desc_dir_la, file_name))
-    url = 'http://centrodedescargas.cnig.es/CentroDescargas/descargaDir'
+    session = session or requests
+    url = '{}/descargaDir'.format(base_url)
     data = {
         'codSerieMD': 'LIDA2',
         'codSerieSel': 'LIDA2',
         'secDescDirLA': sec_desc_dir_la
     }
-    response = requests.post(url, data=data)
-    if response.status_code != 200:
-        print(response.text)
-    else:
-        file_path = os.path.join(lidar_data_dir, file_name)
-        with open(file_path, 'wb') as lidar_file:
-            lidar_file.write(response.content)
-
-
-def download_files(state, lidar_data_dir):
+    part_path = file_path + '.part'
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    try:
+        with session.post(url, data=data, headers=headers, stream=True) as response:
+            if response.status_code == 416:
+                # The part file already has the whole content
+                os.replace(part_path, file_path)
+                return file_path
+            if response.status_code not in (200, 206):
+                print(response.text)
+                return None
+            if response.status_code == 200:
+                # Range not supported: start over
+                offset = 0
+            expected = response.headers.get('Content-Length')
+            if expected is not None and not response.headers.get('Content-Encoding'):
+                expected = offset + int(expected)
+            else:
+                expected = None
+            with open(part_path, 'ab' if offset else 'wb') as lidar_file:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    lidar_file.write(chunk)
+    except requests.RequestException as e:
+        print('>>>>> Error. Descarga de {} interrumpida: {}'.format(file_name, e))
+        return None
+
+    if expected is not None and os.path.getsize(part_path) != expected:
+        print('>>>>> Error. Descarga de {} incompleta'.format(file_name))
+        return None
+    os.replace(part_path, file_path)
+    return file_path
+
+
+def download_files(state, lidar_data_dir, workers=8, base_url=CNIG_URL):
     """
     Este método comienza la descarga de cada uno de los ficheros LIDAR
     a partir del fichero que contiene los identificadores de los enlaces
     de descarga.
 
+    Las descargas se hacen en paralelo con workers hilos que comparten las
+    conexiones de una misma sesión. Devuelve las rutas de los ficheros
+    descargados (None para los que han fallado).
+
     """
 
-    fetch_doc_list(state, lidar_data_dir)
+    session = create_session(workers)
+    fetch_doc_list(state, lidar_data_dir, session=session, workers=workers, base_url=base_url)
 
     lidar_doc_file_path = os.path.join(lidar_data_dir, LIDAR_IDS_DOC)
     with open(lidar_doc_file_path, 'r') as f:
-        for f_line in f:
-            file_name, sec_desc_dir_la = f_line.rstrip().split(',')
-            download_file(file_name, sec_desc_dir_la, lidar_data_dir)
+        docs = [f_line.rstrip().split(',') for f_line in f]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(
+            lambda doc: download_file(doc[0], doc[1], lidar_data_dir, session=session, base_url=base_url),
+            docs))
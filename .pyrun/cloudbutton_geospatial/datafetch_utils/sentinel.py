@@ -15,7 +15,10 @@ https://sentinelsat.readthedocs.io/en/stable/api.html
 import collections
 import os
 import os.path
+import re
+import shutil
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import sentinelsat
 
@@ -29,6 +32,9 @@ GRANULE_DIR = 'GRANULE'
 IMAGE_DATA_DIR = 'IMG_DATA'
 SAFE_EXTENSION = '.SAFE'
 JP2_EXTENSION = '.jp2'
+# Imágenes de las bandas dentro del zip de un producto (L1C o L2A)
+BAND_MEMBER = re.compile(r'/GRANULE/[^/]+/IMG_DATA/(?:R(?P<dir_res>\d+)m/)?[^/]+_(?P<band>[A-Z0-9]{3})'
+                         r'(?:_(?P<res>\d+)m)?\.jp2$')
 
 
 def download_products(tiles, start_date, end_date, output_folder, show_progressbars=True):
@@ -117,24 +123,123 @@ def download_products(tiles, start_date, end_date, output_folder, show_progressb
 #         extract_bands(sentinel_data_dir, sentinel_downloads_dir, sentinel_zip_filename, bands)
 
 
-def unzip_bands_dirs(sentinel_downloads_dir):
+def band_members(sentinel_zip_filename, bands, resolution=10):
+    """
+    Recupera del directorio central del zip de un producto los ficheros de las
+    bandas *bands*, sin leer ni descomprimir su contenido.
+
+    :param sentinel_zip_filename: Fichero zip del producto
+    :param bands: Nombre de las bandas (B04, B08...)
+    :param resolution: Resolución de las bandas en los productos L2A, que las tienen en varias.
+        Las bandas que no existen a esa resolución (B05, B8A, B11, SCL... a 10 m) se toman
+        a su resolución nativa, la más fina disponible
+    :return: Diccionario banda -> fichero dentro del zip
+    """
+
+    # banda -> {resolución (None en L1C): fichero}
+    candidates = {}
+    with zipfile.ZipFile(sentinel_zip_filename) as zip_ref:
+        for name in zip_ref.namelist():
+            match = BAND_MEMBER.search(name)
+            if not match or match.group('band') not in bands:
+                continue
+            member_res = match.group('dir_res') or match.group('res')
+            candidates.setdefault(match.group('band'), {})[int(member_res) if member_res else None] = name
+
+    missing = [band for band in bands if band not in candidates]
+    if missing:
+        raise ValueError(f'Bands {missing} not found in {sentinel_zip_filename}')
+    members = {}
+    for band, by_res in candidates.items():
+        if None in by_res:
+            members[band] = by_res[None]
+        elif resolution in by_res:
+            members[band] = by_res[resolution]
+        else:
+            native = min(by_res)
+            print(f'{band} is not available at {resolution} m, using its native {native} m')
+            members[band] = by_res[native]
+    return members
+
+
+def vsizip_bands(sentinel_zip_filename, bands, resolution=10):
+    """
+    Rutas /vsizip/ de GDAL para abrir las bandas directamente desde el zip,
+    sin extraerlas.
+
+    :param sentinel_zip_filename: Fichero zip del producto
+    :param bands: Nombre de las bandas (B04, B08...)
+    :param resolution: Resolución de las bandas en los productos L2A
+    :return: Diccionario banda -> ruta /vsizip/
+    """
+
+    zip_path = os.path.abspath(sentinel_zip_filename)
+    return {band: f'/vsizip/{zip_path}/{member}'
+            for band, member in band_members(sentinel_zip_filename, bands, resolution).items()}
+
+
+def extract_bands(sentinel_zip_filename, sentinel_downloads_dir, bands, resolution=10):
+    """
+    Extrae del zip de un producto únicamente los ficheros de las bandas
+    *bands*, manteniendo la estructura del directorio .SAFE. Los ficheros
+    ya extraídos con el mismo tamaño no se vuelven a extraer.
+
+    :param sentinel_zip_filename: Fichero zip del producto
+    :param sentinel_downloads_dir: Directorio en el que extraer las bandas
+    :param bands: Nombre de las bandas (B04, B08...)
+    :param resolution: Resolución de las bandas en los productos L2A
+    :return: Diccionario banda -> fichero extraído
+    """
+
+    extracted = {}
+    members = band_members(sentinel_zip_filename, bands, resolution)
+    with zipfile.ZipFile(sentinel_zip_filename) as zip_ref:
+        for band, member in members.items():
+            band_path = os.path.join(sentinel_downloads_dir, *member.split('/'))
+            if not (os.path.exists(band_path) and os.path.getsize(band_path) == zip_ref.getinfo(member).file_size):
+                print(f'Extracting {member}')
+                os.makedirs(os.path.dirname(band_path), exist_ok=True)
+                with zip_ref.open(member) as src, open(band_path + '.part', 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                os.replace(band_path + '.part', band_path)
+            extracted[band] = band_path
+    return extracted
+
+
+def unzip_bands_dirs(sentinel_downloads_dir, bands=None, workers=None):
+    """
+    Descomprime los productos descargados en varios hilos. Con *bands* solo se
+    extraen esas bandas; sin ellas se extrae el producto entero, como necesita
+    la corrección atmosférica de Sen2Cor.
+
+    :param sentinel_downloads_dir: Directorio con los zip de los productos
+    :param bands: Nombre de las bandas a extraer
+    :param workers: Número de productos procesados a la vez
+    :return: Diccionario zip -> bandas extraídas (None si se ha extraído entero)
+    """
+
     print('Unzipping bands')
     sentinel_file_names = [os.path.join(sentinel_downloads_dir, f) for f in os.listdir(sentinel_downloads_dir) if
                            (os.path.isfile(os.path.join(sentinel_downloads_dir, f))) and (f.endswith(ZIP_EXTENSION))]
-    for sentinel_zip_filename in sentinel_file_names:
+
+    def unzip(sentinel_zip_filename):
         print(f'Unzipping {sentinel_zip_filename}')
-        zip_ref = zipfile.ZipFile(sentinel_zip_filename)
-        zip_ref.extractall(sentinel_downloads_dir)
-        zip_ref.close()
+        if bands:
+            return extract_bands(sentinel_zip_filename, sentinel_downloads_dir, bands)
+        with zipfile.ZipFile(sentinel_zip_filename) as zip_ref:
+            zip_ref.extractall(sentinel_downloads_dir)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(sentinel_file_names, executor.map(unzip, sentinel_file_names)))
 
 
-def download_bands(tiles, start_date, end_date, sentinel_downloads_dir):
+def download_bands(tiles, start_date, end_date, sentinel_downloads_dir, bands=None):
 
     print('Downloading bands from Sentinel')
     download_products(tiles=tiles,
                       start_date=start_date,
                       end_date=end_date,
                       output_folder=sentinel_downloads_dir)
-    unzip_bands_dirs(sentinel_downloads_dir)
+    unzip_bands_dirs(sentinel_downloads_dir, bands)
     # extract_bands_from_downloads(sentinel_data_dir, sentinel_downloads_dir)
     print('Downloading bands from Sentinel finished')
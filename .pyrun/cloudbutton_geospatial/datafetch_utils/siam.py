@@ -9,14 +9,24 @@ FECHA DE CREACIÓN: 11/02/2019
 
 """
 
+import datetime
 import os
+import re
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import requests
 from bs4 import BeautifulSoup
 
 RESULTS_DIR = 'results'
 SIAM_RESULTS_DIR = 'siam'
+SIAM_FILE = re.compile(r'siam_(\d{2})_(\d{2})_(\d{4})\.csv$')
+# Variables del almacén columnar. Los nombres de las columnas de humedad y
+# viento del informe diario no se conocen de antemano y hay que indicarlos.
+SIAM_FIELDS = ('temperature', 'humidity', 'wind')
+# Posición de la temperatura media, la que lee temperature_by_station
+TEMPERATURE_COLUMN = 3
 
 
 def download_weather_info(siam_data_dir):
@@ -71,3 +81,131 @@ def temperature_by_station(filename):
             values = clean_row(row).split(';')
             temperatures[values[0]] = float(values[3].replace(',', '.'))
     return temperatures
+
+
+def siam_file_date(filename):
+    """
+    Fecha del informe a partir del nombre del fichero (siam_DD_MM_YYYY.csv).
+    """
+    match = SIAM_FILE.search(os.path.basename(filename))
+    if not match:
+        raise ValueError(f'{filename} is not a SIAM report file')
+    day, month, year = (int(value) for value in match.groups())
+    return datetime.date(year, month, day)
+
+
+def _parse_value(value):
+    value = value.strip().replace(',', '.')
+    return float(value) if value else np.nan
+
+
+def read_siam_csv(filename, fields=None):
+    """
+    Lee un informe diario del SIAM. Devuelve los códigos de las estaciones y,
+    por cada variable leída, un array con su valor en cada estación (NaN si
+    falta).
+
+    La temperatura se lee siempre de la columna TEMPERATURE_COLUMN, como en
+    temperature_by_station. La humedad y el viento solo se leen si se indica
+    en fields el nombre de su columna en el encabezado del informe, y se
+    lanza una excepción si el encabezado no la contiene.
+
+    :param filename: Fichero CSV del informe
+    :param fields: Nombre de la columna de cada variable adicional, p.ej. {'humidity': ..., 'wind': ...}
+    """
+    fields = fields or {}
+    unknown = set(fields) - set(SIAM_FIELDS) - {'temperature'}
+    if unknown:
+        raise ValueError(f'Unknown SIAM fields {sorted(unknown)}, valid values are {list(SIAM_FIELDS)}')
+    with open(filename, 'r', encoding='windows-1252') as csv_file:
+        header = [column.strip().upper() for column in csv_file.readline().replace('"', '').split(';')]
+        rows = [row.replace('"', '').rstrip('\r\n').split(';') for row in csv_file if row.strip()]
+
+    columns = {'temperature': TEMPERATURE_COLUMN}
+    for field, name in fields.items():
+        if field == 'temperature':
+            continue
+        if name.upper() not in header:
+            raise ValueError(f'{filename}: column {name} of {field} not found in the header {header}')
+        columns[field] = header.index(name.upper())
+
+    stations = [row[0] for row in rows]
+    values = {}
+    for field, column in columns.items():
+        values[field] = np.array([_parse_value(row[column]) if column < len(row) else np.nan for row in rows],
+                                 dtype='float64')
+    return stations, values
+
+
+class SiamStore:
+    """
+    Datos de varios días del SIAM en formato columnar: un array
+    estaciones x días por cada variable leída (temperature y, si se han
+    pedido, humidity y wind), con NaN donde falta el dato.
+    """
+
+    def __init__(self, stations, dates, values):
+        self.stations = np.asarray(stations)
+        self.dates = list(dates)
+        self.values = values
+        self._station_index = {station: i for i, station in enumerate(self.stations)}
+
+    def _field(self, field):
+        if field not in self.values:
+            raise KeyError(f'{field} was not loaded, pass its column name in fields')
+        return self.values[field]
+
+    @property
+    def temperature(self):
+        return self._field('temperature')
+
+    @property
+    def humidity(self):
+        return self._field('humidity')
+
+    @property
+    def wind(self):
+        return self._field('wind')
+
+    def station_index(self, stations):
+        """
+        Posición de cada estación en el almacén (-1 si no está).
+        """
+        return np.array([self._station_index.get(station, -1) for station in stations], dtype='int64')
+
+    def day(self, date, field='temperature'):
+        """
+        Valores de un día como diccionario estación -> valor, como
+        temperature_by_station.
+        """
+        column = self._field(field)[:, self.dates.index(date)]
+        return {str(station): float(value) for station, value in zip(self.stations, column) if not np.isnan(value)}
+
+
+def load_siam_files(filenames, workers=None, fields=None):
+    """
+    Carga los informes diarios de muchos días en un SiamStore. Las estaciones
+    son la unión de las de todos los ficheros y los días se ordenan por fecha.
+    Ver read_siam_csv para fields.
+    """
+    filenames = sorted(filenames, key=siam_file_date)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        reports = list(executor.map(lambda filename: read_siam_csv(filename, fields), filenames))
+
+    stations = sorted({station for report_stations, _ in reports for station in report_stations})
+    station_index = {station: i for i, station in enumerate(stations)}
+    loaded = reports[0][1].keys() if reports else ('temperature',)
+    values = {field: np.full((len(stations), len(filenames)), np.nan) for field in loaded}
+    for day, (report_stations, report_values) in enumerate(reports):
+        rows = [station_index[station] for station in report_stations]
+        for field in loaded:
+            values[field][rows, day] = report_values[field]
+    return SiamStore(stations, [siam_file_date(filename) for filename in filenames], values)
+
+
+def load_siam_dir(siam_data_dir, workers=None, fields=None):
+    """
+    Carga todos los informes diarios de un directorio en un SiamStore.
+    """
+    filenames = [os.path.join(siam_data_dir, name) for name in os.listdir(siam_data_dir) if SIAM_FILE.search(name)]
+    return load_siam_files(filenames, workers, fields)
@@ -7,25 +7,23 @@ DATE: 02/04/2019
 """
 
 import os
-import subprocess
+
+from ..io_utils.sen2cor import run_atmospheric_corrections
 
 
 class AtmosphericCorrectionProcess:
 
     @staticmethod
-    def run(products_dir):
+    def run(products_dir, workers=None, command=None):
         # Usar el software de corrección atmosférica Sen2Cor
         # Este crea los modelos con corrección L2A
-        # TODO: Tendremos que probar con la versión para Linux
-        if "SEN2COR_COM" not in os.environ:
+        # Los productos con la corrección ya terminada no se vuelven a procesar
+        if command is None and "SEN2COR_COM" not in os.environ:
             print(f'Variable SEN2COR_COM should be defined. It must contain path of L2A_Process command')
             return
 
         sentinel_products_dirs = [os.path.join(products_dir, d) for d in os.listdir(products_dir) if
                                   (os.path.isdir(os.path.join(products_dir, d))) and ('MSIL1C' in d)]
 
-        for sentinel_product in sentinel_products_dirs:
-            print(f'Doing the atmospheric correction for {sentinel_product}')
-            val = subprocess.check_call(
-                f'{os.environ["SEN2COR_COM"]} --resolution 10 {sentinel_product}', shell=True)
-            print(f'Atmospheric correction finished {val}')
+        corrected = run_atmospheric_corrections(sentinel_products_dirs, command=command, workers=workers)
+        return [corrected[sentinel_product] for sentinel_product in sentinel_products_dirs]
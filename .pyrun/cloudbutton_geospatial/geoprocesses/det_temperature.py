@@ -7,13 +7,40 @@ DATE: 06/02/2019
 
 """
 
+import numpy as np
+
+
+def det_temperature(temperatures, altitudes, rate=-0.0056, det_alt=2000):
+    """
+    Temperatura determinada a det_alt metros de un array de temperaturas por
+    estación (estaciones o estaciones x días) y la altitud de cada estación.
+    """
+    temperatures = np.asarray(temperatures, dtype='float64')
+    correction = rate * (det_alt - np.asarray(altitudes, dtype='float64'))
+    return temperatures + correction.reshape(correction.shape + (1,) * (temperatures.ndim - correction.ndim))
+
+
+def station_altitudes(stations_info, stations):
+    """
+    Altitud de cada estación (NaN si no está en stations_info).
+    """
+    return np.array([stations_info[station]['alt'] if station in stations_info else np.nan
+                     for station in stations], dtype='float64')
+
 
 class DetTemperatureProcess:
 
     @staticmethod
     def run(stations_info, temperatures, rate=-0.0056, det_alt=2000):
-        det_temperature = {}
-        for station in stations_info:
-            if station in temperatures:
-                det_temperature[station] = temperatures[station] + rate*(det_alt - stations_info[station]['alt'])
-        return det_temperature
+        stations = [station for station in stations_info if station in temperatures]
+        values = det_temperature([temperatures[station] for station in stations],
+                                 station_altitudes(stations_info, stations), rate, det_alt)
+        return dict(zip(stations, values.tolist()))
+
+    @staticmethod
+    def run_store(stations_info, store, rate=-0.0056, det_alt=2000):
+        """
+        Temperatura determinada de todas las estaciones y días de un SiamStore
+        (estaciones x días), NaN para las estaciones sin altitud conocida.
+        """
+        return det_temperature(store.temperature, station_altitudes(stations_info, store.stations), rate, det_alt)
@@ -6,84 +6,180 @@ DATE: 02/04/2019
 
 """
 
+import glob
 import os
-import subprocess
+import shutil
+import tempfile
+
+from osgeo import ogr
+
+from .utils import ndvi_threshold_masks
+
+
+# SIGPAC land uses (uso_sigpac) of every land class. A use can belong to
+# several classes.
+LAND_USE_CLASSES = {
+    'cultivable': ['CI', 'CF', 'CO', 'CS', 'CV', 'FF', 'FL', 'FS', 'FV', 'FY', 'IS', 'IV', 'OC', 'OF', 'OV', 'PS', 'TA', 'TH', 'VF', 'VI', 'VO', 'ZC'],
+    'uncultivable': ['AG', 'CA', 'ED', 'FO', 'IM', 'PA', 'PR', 'ZU', 'ZV'],
+    'irrigated': ['CI', 'CF', 'CS', 'CV', 'FF', 'FY', 'IV', 'OC', 'OF', 'TA', 'TH', 'VF', 'VI'],
+    'wood': ['CI', 'CF', 'CS', 'CV', 'FF', 'FL', 'FS', 'FV', 'FY', 'OC', 'OF', 'OV', 'VF', 'VO'],
+}
+
+OGR_DRIVERS = {
+    '.gpkg': 'GPKG',
+    '.shp': 'ESRI Shapefile',
+}
+
+
+def land_use_lookup(classes):
+    # uso_sigpac -> names of the classes it belongs to
+    lookup = {}
+    for name, uses in classes.items():
+        for use in uses:
+            lookup.setdefault(use, []).append(name)
+    return lookup
+
+
+def _write_partition(src_lyr, field, lookup, pending, tmp_dir):
+    # Write the pending outputs in tmp_dir and move each one to its path
+    src_defn = src_lyr.GetLayerDefn()
+    tmp_paths = {}
+    for name, path in pending.items():
+        os.mkdir(os.path.join(tmp_dir, name))
+        tmp_paths[name] = os.path.join(tmp_dir, name, os.path.basename(path))
+    sinks = {}
+    for name, path in tmp_paths.items():
+        extension = os.path.splitext(path)[1].lower()
+        out_ds = ogr.GetDriverByName(OGR_DRIVERS[extension]).CreateDataSource(path)
+        geom_type = ogr.wkbUnknown if extension == '.gpkg' else src_defn.GetGeomType()
+        out_lyr = out_ds.CreateLayer(name, srs=src_lyr.GetSpatialRef(), geom_type=geom_type)
+        for i in range(src_defn.GetFieldCount()):
+            out_lyr.CreateField(src_defn.GetFieldDefn(i))
+        out_lyr.StartTransaction()
+        sinks[name] = (out_ds, out_lyr)
+
+    for feat in (src_lyr if lookup else ()):
+        for name in lookup.get(feat.GetField(field), ()):
+            out_ds, out_lyr = sinks[name]
+            out_feat = ogr.Feature(out_lyr.GetLayerDefn())
+            out_feat.SetFrom(feat)
+            out_lyr.CreateFeature(out_feat)
+
+    for out_ds, out_lyr in sinks.values():
+        out_lyr.CommitTransaction()
+    del sinks, out_lyr, out_ds
+
+    for name, tmp_path in tmp_paths.items():
+        if tmp_path.lower().endswith('.shp'):
+            out_ds = ogr.Open(tmp_path, 1)
+            out_ds.ExecuteSQL('CREATE SPATIAL INDEX ON "{}"'.format(out_ds.GetLayer(0).GetName()))
+            del out_ds
+        # Sidecar files (.dbf, .shx, .qix...) first, the main file last
+        stem = os.path.splitext(tmp_path)[0]
+        for sidecar in glob.glob(glob.escape(stem) + '.*'):
+            if sidecar != tmp_path:
+                os.replace(sidecar, os.path.join(os.path.dirname(pending[name]), os.path.basename(sidecar)))
+        os.replace(tmp_path, pending[name])
+
+
+def partition_land_use(in_shapefile, dst_dir, outputs, field='uso_sigpac', classes=None):
+    """
+    Split the parcels of in_shapefile into land classes reading it only once.
+
+    outputs maps a class of LAND_USE_CLASSES (or of classes) to its output
+    file name, a GeoPackage (.gpkg) or a shapefile (.shp). Both are spatially
+    indexed: the GeoPackage with its R-tree and the shapefile with a .qix
+    file. Parcels are written to every class their use belongs to, and a
+    class without uses gets an empty output. Existing outputs are kept.
+    Returns a dict with the path of every output.
+
+    Outputs are written to a temporary directory and moved to dst_dir once
+    complete, so an interrupted run does not leave partial outputs that
+    later runs would keep.
+    """
+    classes = LAND_USE_CLASSES if classes is None else classes
+    paths = {name: os.path.join(dst_dir, out_name) for name, out_name in outputs.items()}
+    for path in paths.values():
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in OGR_DRIVERS:
+            raise ValueError(f'Unsupported output format {extension}')
+    pending = {name: path for name, path in paths.items() if not os.path.exists(path)}
+    if not pending:
+        return paths
+
+    lookup = land_use_lookup({name: classes[name] for name in pending})
+    src_ds = ogr.Open(in_shapefile)
+    src_lyr = src_ds.GetLayer()
+    if lookup:
+        # Let OGR skip the parcels that do not belong to any pending class
+        src_lyr.SetAttributeFilter('{} IN ({})'.format(field, ', '.join("'{}'".format(use) for use in lookup)))
+
+    tmp_dir = tempfile.mkdtemp(dir=dst_dir)
+    try:
+        _write_partition(src_lyr, field, lookup, pending, tmp_dir)
+    finally:
+        del src_lyr, src_ds
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return paths
+
+
+class LandUsePartitionProcess:
 
-from geoprocesses.utils import ndvi_filter_calc
-
-
-def create_filtered_shapefile(in_shapefile, filter_fields, dst_dir, out_shapefile_name):
-    # Check if the dst file exists
-    out_shapefile = os.path.join(dst_dir, out_shapefile_name)
-    if os.path.exists(out_shapefile):
-        return out_shapefile
-
-    # Create query string
-    filters = []
-    for k, v in filter_fields.items():
-        if isinstance(v, list):
-            for item in v:
-                filters.append("{} = '{}'".format(k, item))
-        else:
-            filters.append("{} = '{}'".format(k, v))
-    query_str = ' or '.join(filters)
-
-    val = subprocess.check_call(f'ogr2ogr -where "{query_str}" {out_shapefile} {in_shapefile}', shell=True)
-    if val == 0:
-        return out_shapefile
-    else:
-        return None
+    @staticmethod
+    def run(in_shapefile, dst_dir, outputs=None):
+        if outputs is None:
+            outputs = {name: f'{name}.gpkg' for name in LAND_USE_CLASSES}
+        return partition_land_use(in_shapefile, dst_dir, outputs)
 
 
 class CultivableLandFilterProcess:
 
     @staticmethod
     def run(in_shapefile, dst_dir, out_shapefile_name):
-        filter_fields = {
-            'uso_sigpac': ['CI', 'CF', 'CO', 'CS', 'CV', 'FF', 'FL', 'FS', 'FV', 'FY', 'IS', 'IV', 'OC', 'OF', 'OV', 'PS', 'TA', 'TH', 'VF', 'VI', 'VO', 'ZC']
-        }
-        return create_filtered_shapefile(in_shapefile, filter_fields, dst_dir, out_shapefile_name)
+        return partition_land_use(in_shapefile, dst_dir, {'cultivable': out_shapefile_name})['cultivable']
 
 
 class UncultivableLandFilterProcess:
 
     @staticmethod
     def run(in_shapefile, dst_dir, out_shapefile_name):
-        filter_fields = {
-            'uso_sigpac': ['AG', 'CA', 'ED', 'FO', 'IM', 'PA', 'PR', 'ZU', 'ZV']
-        }
-        return create_filtered_shapefile(in_shapefile, filter_fields, dst_dir, out_shapefile_name)
+        return partition_land_use(in_shapefile, dst_dir, {'uncultivable': out_shapefile_name})['uncultivable']
 
 
 class IrrigatedLandFilterProcess:
 
     @staticmethod
     def run(in_shapefile, dst_dir, out_shapefile_name):
-        filter_fields = {
-            'uso_sigpac': ['CI', 'CF', 'CS', 'CV', 'FF', 'FY', 'IV', 'OC', 'OF', 'TA', 'TH', 'VF', 'VI']
-        }
-        return create_filtered_shapefile(in_shapefile, filter_fields, dst_dir, out_shapefile_name)
+        return partition_land_use(in_shapefile, dst_dir, {'irrigated': out_shapefile_name})['irrigated']
 
 
 class WoodLandFilterProcess:
 
     @staticmethod
     def run(in_shapefile, dst_dir, out_shapefile_name):
-        filter_fields = {
-            'uso_sigpac': ['CI', 'CF', 'CS', 'CV', 'FF', 'FL', 'FS', 'FV', 'FY', 'OC', 'OF', 'OV', 'VF', 'VO']
-        }
-        return create_filtered_shapefile(in_shapefile, filter_fields, dst_dir, out_shapefile_name)
+        return partition_land_use(in_shapefile, dst_dir, {'wood': out_shapefile_name})['wood']
 
 
 class CultivatedLandFilterProcess:
 
     @staticmethod
-    def run(ndvi_file_path, dst_dir, out_filename):
-        ndvi_filter_calc(ndvi_file_path, '"254 * (A >= 0.3)"', dst_dir, out_filename)
+    def run(ndvi_file_path, dst_dir, out_filename, threshold=0.3):
+        ndvi_threshold_masks(ndvi_file_path, dst_dir, {out_filename: ('>=', threshold)})
 
 
 class NakedLandFilterProcess:
 
     @staticmethod
-    def run(ndvi_file_path, dst_dir, out_filename):
-        ndvi_filter_calc(ndvi_file_path, '"254 * (A < 0.3)"', dst_dir, out_filename)
+    def run(ndvi_file_path, dst_dir, out_filename, threshold=0.3):
+        ndvi_threshold_masks(ndvi_file_path, dst_dir, {out_filename: ('<', threshold)})
+
+
+class NDVILandFilterProcess:
+
+    @staticmethod
+    def run(ndvi_file_path, dst_dir, cultivated_filename, naked_filename, threshold=0.3):
+        # Both complementary masks in a single read of the NDVI raster
+        return ndvi_threshold_masks(ndvi_file_path, dst_dir, {
+            cultivated_filename: ('>=', threshold),
+            naked_filename: ('<', threshold),
+        })
@@ -8,18 +8,105 @@ DATE: 02/04/2019
 """
 
 import os
-import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import fiona
+from shapely.geometry import MultiPolygon, mapping, shape
+from shapely.ops import unary_union
+
+from .land_filters import OGR_DRIVERS
+from ..io_utils.parcels import ParcelIndex
+from ..utils.crs import transform_geometry
+
+
+def load_parcels(parcels_file):
+    """
+    Loads the parcels once: the collection metadata, the properties of every
+    parcel and a spatial index over their geometries.
+    """
+    with fiona.open(parcels_file) as src:
+        meta = src.meta
+        meta['crs_wkt'] = src.crs_wkt
+        properties = []
+        geometries = []
+        for feature in src:
+            if feature['geometry'] is None:
+                continue
+            geometries.append(shape(feature['geometry']))
+            properties.append(dict(feature['properties']))
+    return meta, properties, ParcelIndex(geometries)
+
+
+def _to_multipolygon(geometry):
+    # Clipping can also produce lines or points on the border of the area
+    if geometry.geom_type == 'Polygon':
+        return MultiPolygon([geometry])
+    if geometry.geom_type == 'MultiPolygon':
+        return geometry
+    polygons = []
+    for part in getattr(geometry, 'geoms', []):
+        polygons.extend(_to_multipolygon(part).geoms)
+    return MultiPolygon(polygons)
+
+
+def clip_parcels(parcels, study_area, parcels_file_name):
+    """
+    Writes the parcels of the study area clipped to it. Candidates are
+    selected by bounding box and only the parcels crossing the border are
+    clipped exactly.
+    """
+    meta, properties, index = parcels
+    with fiona.open(study_area) as src:
+        area = unary_union([shape(feature['geometry']) for feature in src])
+        # Without a .prj in either file the study area is used as it is
+        if src.crs_wkt and meta['crs_wkt']:
+            area = transform_geometry(src.crs_wkt, meta['crs_wkt'], area)
+
+    extension = os.path.splitext(parcels_file_name)[1].lower()
+    out_meta = dict(meta, driver=OGR_DRIVERS.get(extension, 'ESRI Shapefile'))
+    out_meta['schema'] = dict(meta['schema'], geometry='MultiPolygon')
+    with fiona.open(parcels_file_name, 'w', **out_meta) as dst:
+        for idx, geometry in index.clip(area):
+            geometry = _to_multipolygon(geometry)
+            if not geometry.is_empty:
+                dst.write({'geometry': mapping(geometry), 'properties': properties[idx]})
+    return parcels_file_name
+
+
+# Parcels loaded once in each worker process of SelectParcelProcess
+_parcels = None
+
+
+def _set_parcels(parcels):
+    global _parcels
+    _parcels = parcels
+
+
+def _select(area, parcels_file_name):
+    return clip_parcels(_parcels, area, parcels_file_name)
 
 
 class SelectParcelProcess:
 
     @staticmethod
-    def run(parcels_dir, parcels_file, study_area):
+    def run(parcels_dir, parcels_file, study_area, workers=None):
+        """
+        study_area can be a single study area file or a list of them. The
+        parcels are loaded once and several study areas are clipped in
+        parallel in worker processes, which inherit the loaded parcels when
+        processes are forked.
+        """
         print('Selecting parcels from study area')
-        study_area_dir, study_area_filename = os.path.split(study_area)
-        parcels_file_name = os.path.join(parcels_dir, study_area_filename)
+        study_areas = [study_area] if isinstance(study_area, str) else list(study_area)
+        parcels_file_names = [os.path.join(parcels_dir, os.path.basename(area)) for area in study_areas]
+        parcels = load_parcels(parcels_file)
 
-        # Cómo instalar GDAL en Windows http://www.sigdeletras.com/2016/instalacion-de-python-y-gdal-en-windows/
-        val = subprocess.check_call(f'ogr2ogr -clipsrc {study_area} {parcels_file_name} {parcels_file}')
-        print(f'ogr2ogr - Selecting parcels has finished {val}')
-        return parcels_file_name
+        if len(study_areas) == 1 or workers == 1:
+            parcels_file_names = [clip_parcels(parcels, area, parcels_file_name)
+                                  for area, parcels_file_name in zip(study_areas, parcels_file_names)]
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_set_parcels,
+                                     initargs=(parcels,)) as executor:
+                parcels_file_names = list(executor.map(_select, study_areas, parcels_file_names))
+        print('Selecting parcels has finished')
+        return parcels_file_names[0] if isinstance(study_area, str) else parcels_file_names
@@ -10,13 +10,15 @@ import os
 
 import subprocess
 
+import numpy as np
+import rasterio
 
-def jp2_to_gtiff(jp2_filepath, gtif_filepath, otype='Float32'):
-    # Cómo instalar GDAL en Windows http://www.sigdeletras.com/2016/instalacion-de-python-y-gdal-en-windows/
-
-    print('Invoca a gdal_translate')
-    val = subprocess.check_call(f'gdal_translate -ot "{otype}" -of "Gtiff" {jp2_filepath} {gtif_filepath}', shell=True)
-    print(f'gdal_translate ha finalizado con valor {val}')
+THRESHOLD_OPS = {
+    '>=': np.greater_equal,
+    '>': np.greater,
+    '<=': np.less_equal,
+    '<': np.less,
+}
 
 
 def select_b4_b8_bands(product_dir):
@@ -53,3 +55,71 @@ def ndvi_filter_calc(ndvi_file_path, calc_expr, dst_dir, out_filename, nodata='0
     gdal_calc_process = f'python {gdal_calc_path} -A {ndvi_file_path} --outfile={output_file_path} --calc={calc_expr} --NoDataValue={nodata} --type={typeof}'
 
     subprocess.check_call(gdal_calc_process, shell=True)
+
+
+def _ndvi_blocks(src):
+    # NDVI blocks in NDVI units (int16 rasters are divided by their
+    # NDVI_SCALE tag) together with their invalid (nodata) pixels
+    scale = float(src.tags().get('NDVI_SCALE', 1))
+    for _, window in src.block_windows(1):
+        block = src.read(1, window=window, masked=True)
+        ndvi = block.data.astype('float32') / scale
+        invalid = np.ma.getmaskarray(block) | ~np.isfinite(ndvi)
+        yield window, ndvi, invalid
+
+
+def _mask_profile(src, nodata):
+    return {
+        'driver': 'GTiff',
+        'dtype': 'uint8',
+        'count': 1,
+        'width': src.width,
+        'height': src.height,
+        'crs': src.crs,
+        'transform': src.transform,
+        'nodata': nodata,
+        'tiled': True,
+        'blockxsize': 256,
+        'blockysize': 256,
+        'compress': 'DEFLATE',
+    }
+
+
+def ndvi_threshold_masks(ndvi_file_path, dst_dir, outputs, value=254, nodata=0):
+    """
+    Writes any number of NDVI threshold masks reading the NDVI raster once,
+    block by block. outputs maps each output file name to an (op, threshold)
+    pair, e.g. {'cultivated.tif': ('>=', 0.3)}. Matching pixels get value and
+    the rest 0, like gdal_calc "254 * (A >= 0.3)"; NDVI nodata pixels get
+    nodata.
+    """
+    with rasterio.open(ndvi_file_path) as src:
+        profile = _mask_profile(src, nodata)
+        dsts = {out_filename: rasterio.open(os.path.join(dst_dir, out_filename), 'w', **profile)
+                for out_filename in outputs}
+        try:
+            for window, ndvi, invalid in _ndvi_blocks(src):
+                for out_filename, (op, threshold) in outputs.items():
+                    mask = np.where(THRESHOLD_OPS[op](ndvi, threshold), value, 0).astype('uint8')
+                    mask[invalid] = nodata
+                    dsts[out_filename].write(mask, 1, window=window)
+        finally:
+            for dst in dsts.values():
+                dst.close()
+    return [os.path.join(dst_dir, out_filename) for out_filename in outputs]
+
+
+def ndvi_classes(ndvi_file_path, dst_dir, out_filename, thresholds=(0.3,), nodata=255):
+    """
+    Writes a single uint8 class raster in one pass over the NDVI raster:
+    class i holds the pixels with thresholds[i-1] <= NDVI < thresholds[i].
+    """
+    thresholds = np.sort(np.asarray(thresholds, dtype='float32'))
+    output_file_path = os.path.join(dst_dir, out_filename)
+    with rasterio.open(ndvi_file_path) as src:
+        with rasterio.open(output_file_path, 'w', **_mask_profile(src, nodata)) as dst:
+            for window, ndvi, invalid in _ndvi_blocks(src):
+                classes = np.digitize(ndvi, thresholds).astype('uint8')
+                classes[invalid] = nodata
+                dst.write(classes, 1, window=window)
+    return output_file_path
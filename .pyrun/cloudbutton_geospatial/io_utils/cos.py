@@ -1,17 +1,25 @@
 import re
 import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import ibm_boto3
 import ibm_botocore
 from ibm_botocore.credentials import DefaultTokenManager
 from ibm_botocore.client import ClientError
 from geojson import Feature, FeatureCollection, dump
 
+MAX_POOL_CONNECTIONS = 128
+
+# Uploaded items are named {date}-{tile_id}-{file}, see upload_band_file
+ITEM_PREFIX = re.compile(r'^(\d{8})-(\w{5})-')
 
 
 class COS:
-    def __init__(self, ibm_api_key_id, ibm_service_instance_id, endpoint_url, bucket):
+    def __init__(self, ibm_api_key_id, ibm_service_instance_id, endpoint_url, bucket, listing_ttl=300):
         client_config = ibm_botocore.client.Config(signature_version='oauth',
-                                                   max_pool_connections=128)
+                                                   max_pool_connections=MAX_POOL_CONNECTIONS)
 
         self.cos = ibm_boto3.client('s3',
                                     ibm_api_key_id=ibm_api_key_id,
@@ -24,6 +32,84 @@ class COS:
                                     config=client_config,
                                     endpoint_url=endpoint_url)
         self.bucket = bucket
+        self.upload_stats = []
+
+        # Listing index: keys bucketed by (date, tile) prefix. Lookups re-list
+        # the whole bucket once the listing is older than listing_ttl seconds,
+        # so keys outside the {date}-{tile}- pattern (e.g. product geojsons)
+        # are refreshed too. refresh_index(date, tile) re-lists a single prefix.
+        self.listing_ttl = listing_ttl
+        self._index_lock = threading.RLock()
+        self._reset_index()
+
+    def _reset_index(self):
+        self._keys = set()
+        self._prefix_index = defaultdict(set)
+        self._unindexed = set()
+        self._full_listed_at = None
+
+    def _add_key(self, key):
+        with self._index_lock:
+            if key in self._keys:
+                return
+            self._keys.add(key)
+            match = ITEM_PREFIX.match(key)
+            if match:
+                self._prefix_index[match.groups()].add(key)
+            else:
+                self._unindexed.add(key)
+
+    def list_keys(self, prefix=None):
+        """
+        Iterate over all the keys of the bucket, or of the ones starting with
+        prefix, following pagination.
+        """
+        paginator = self.cos.get_paginator('list_objects_v2')
+        kwargs = {'Bucket': self.bucket}
+        if prefix is not None:
+            kwargs['Prefix'] = prefix
+        for page in paginator.paginate(**kwargs):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
+    def refresh_index(self, date=None, tile=None):
+        """
+        Update the listing index. With date and tile only the keys of that
+        {date}-{tile}- prefix are listed again, otherwise the whole bucket is.
+        Deleted keys are dropped in both cases.
+        """
+        with self._index_lock:
+            now = time.monotonic()
+            if date is None or tile is None:
+                keys = list(self.list_keys())
+                self._reset_index()
+                self._full_listed_at = now
+            else:
+                keys = list(self.list_keys(prefix=f"{date}-{tile}-"))
+                self._keys -= self._prefix_index.pop((date, tile), set())
+            for key in keys:
+                self._add_key(key)
+
+    def _ensure_index(self):
+        with self._index_lock:
+            if self._full_listed_at is None or time.monotonic() - self._full_listed_at > self.listing_ttl:
+                self.refresh_index()
+
+    def _find(self, tile, date, extension, band=None):
+        pattern = re.compile(r".*" + \
+            re.escape(date) + \
+            ".*" + \
+            re.escape(tile) + \
+            ("" if band is None else ".*" + re.escape(band)) + \
+            ".*\." + \
+            re.escape(extension))
+        with self._index_lock:
+            self._ensure_index()
+            if re.fullmatch(r'\d{8}', date) and re.fullmatch(r'\w{5}', tile):
+                candidates = self._prefix_index.get((date, tile), set()) | self._unindexed
+            else:
+                candidates = set(self._keys)
+        return sorted(file for file in candidates if pattern.search(file))
     
     def get_object(self, key):
         res = self.cos.get_object(Bucket=self.bucket, Key=key)
@@ -31,22 +117,26 @@ class COS:
     
     def put_object(self, key, obj):
         res = self.cos.put_object(Bucket=self.bucket, Key=key, Body=obj)
+        self._add_key(key)
 
     def get_cos_files(self):
-        res = self.cos.list_objects(Bucket=self.bucket)
-        return [obj['Key'] for obj in res['Contents']]
+        with self._index_lock:
+            self._ensure_index()
+            return sorted(self._keys)
 
 
-    def multi_part_upload(self, item_name, file_path, extra_args=None):
+    def multi_part_upload(self, item_name, file_path, extra_args=None, max_concurrency=10):
         part_size = 1024 * 1024 * 5
         file_threshold = 1024 * 1024 * 15
         transfer_config = ibm_boto3.s3.transfer.TransferConfig(
             multipart_threshold=file_threshold,
-            multipart_chunksize=part_size
+            multipart_chunksize=part_size,
+            max_concurrency=max_concurrency
         )
         self.cos.upload_file(Filename=file_path, Bucket=self.bucket, Key=item_name, Config=transfer_config)
+        self._add_key(item_name)
 
-    def upload_band_file(self, band_tiff_file, product_meta_data={}):
+    def upload_band_file(self, band_tiff_file, product_meta_data={}, max_concurrency=10):
         p = product_meta_data.copy()
         tile_id = band_tiff_file[1:6]
         band = band_tiff_file[23:26]
@@ -67,24 +157,56 @@ class COS:
             "ContentType": "image/tiff",
         }
 
-        return self.multi_part_upload(item_name, band_tiff_file, extra_args=meta_data)
+        return self.multi_part_upload(item_name, band_tiff_file, extra_args=meta_data,
+                                      max_concurrency=max_concurrency)
     
     def check_file(self, item_name):
         try:
             self.cos.head_object(Bucket=self.bucket, Key=item_name)
+            return True
         except Exception:
             return False
 
-    def upload_to_ibm_cloud(self, files, product):
-        uploaded_files = []
-        for file in files:
-            tile_id = file[1:6]
-            date = file[7:15]
-            item_name = f"{date}-{tile_id}-{file}"
-            uploaded_files.append((self.bucket, item_name))
-            if not self.check_file(item_name):
-                self.upload_band_file(file, product)
-        return uploaded_files
+    def upload_to_ibm_cloud(self, files, product, workers=16, check='listing'):
+        """
+        Upload the band files that are not in the bucket yet through a bounded
+        thread pool sharing the client connection pool. Existence is checked
+        with one listing per {date}-{tile}- prefix or, with check='head', concurrent HEADs.
+        Per-file throughput is printed and kept in self.upload_stats.
+        """
+        items = [(file, f"{file[7:15]}-{file[1:6]}-{file}") for file in files]
+        workers = max(1, min(workers, MAX_POOL_CONNECTIONS))
+
+        if check == 'head':
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                exists = list(executor.map(self.check_file, [item_name for _, item_name in items]))
+        else:
+            matches = [ITEM_PREFIX.match(item_name) for _, item_name in items]
+            if all(matches):
+                for date, tile in {match.groups() for match in matches}:
+                    self.refresh_index(date, tile)
+            else:
+                self.refresh_index()
+            with self._index_lock:
+                exists = [item_name in self._keys for _, item_name in items]
+        missing = [item for item, found in zip(items, exists) if not found]
+
+        # Split the connection pool between files and their multipart threads
+        max_concurrency = max(1, MAX_POOL_CONNECTIONS // workers)
+
+        def upload(item):
+            file, item_name = item
+            start = time.perf_counter()
+            self.upload_band_file(file, product, max_concurrency=max_concurrency)
+            seconds = time.perf_counter() - start
+            size = os.path.getsize(file)
+            print(f"Uploaded {item_name}: {size / 2**20:.1f} MB in {seconds:.1f}s "
+                  f"({size / 2**20 / max(seconds, 1e-6):.1f} MB/s)")
+            return {'item': item_name, 'bytes': size, 'seconds': seconds}
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            self.upload_stats = list(executor.map(upload, missing))
+        return [(self.bucket, item_name) for _, item_name in items]
     
     def upload_geojson_file(self, geojson_file, product_meta_data):
         p = product_meta_data.copy()
@@ -122,16 +244,7 @@ class COS:
 
     def check_pattern(self, tile, date, extension, band=None):
         try:
-            files = self.get_cos_files()
-            pattern = r".*" + \
-                re.escape(date) + \
-                ".*" + \
-                re.escape(tile) + \
-                ("" if band is None else ".*" + re.escape(band)) + \
-                ".*\." + \
-                re.escape(extension)
-            filtered = [file for file in files if re.search(pattern, file)]
-            return len(filtered) > 0
+            return len(self._find(tile, date, extension, band)) > 0
         except ClientError as be:
             print("CLIENT ERROR: {0}\n".format(be))
         except Exception as e:
@@ -139,18 +252,9 @@ class COS:
 
     def get_pattern(self, tile, date, extension, band=None):
         try:
-            files = self.get_cos_files()
-            pattern = r".*" + \
-                re.escape(date) + \
-                ".*" + \
-                re.escape(tile) + \
-                ("" if band is None else ".*" + re.escape(band)) + \
-                ".*\." + \
-                re.escape(extension)
-            filtered = [file for file in files if re.search(pattern, file)]
+            filtered = self._find(tile, date, extension, band)
             return filtered[0] if len(filtered) > 0 else None
         except ClientError as be:
             print("CLIENT ERROR: {0}\n".format(be))
         except Exception as e:
             print("Unable to check file existance: {0}".format(e))
-    
\ No newline at end of file
@@ -1,26 +1,65 @@
+import os
+import tempfile
+
 from shapely.geometry import Point, Polygon, MultiPolygon, shape, mapping
 import numpy as np
-import pyproj
 import rasterio
+from rasterio.features import geometry_mask
+from rio_cogeo.cogeo import cog_translate
+from rio_cogeo.profiles import cog_profiles
+
+from .parcels import ParcelIndex
+from ..utils.crs import WGS84, transform_coords, transform_geometries
+
+NDVI_SCALE = 10000
+
+
+def compute_ndvi(red, nir, nodata=None, scale=None, fill=0):
+    """
+    NDVI of a block of red and nir values.
+
+    The sum is computed once and only valid pixels are divided, so the global
+    numpy error state is left alone. Pixels where nir + red is 0, or where any
+    band equals nodata, are reported as fill. With scale (e.g. NDVI_SCALE) the
+    result is NDVI * scale rounded to int16 instead of float32.
+    """
+    ndvi = np.subtract(nir, red, dtype='float32')
+    total = np.add(nir, red, dtype='float32')
+    valid = total != 0
+    if nodata is not None:
+        valid &= (red != nodata) & (nir != nodata)
+    np.divide(ndvi, total, out=ndvi, where=valid)
+    if scale is not None:
+        np.multiply(ndvi, scale, out=ndvi)
+        np.rint(ndvi, out=ndvi)
+    ndvi[~valid] = fill
+    return ndvi if scale is None else ndvi.astype('int16')
 
 
 def get_poly_within(multi_poly, raster_bounds):
-    raster_poly = Polygon([
-        (raster_bounds.left, raster_bounds.top),
-        (raster_bounds.right, raster_bounds.top),
-        (raster_bounds.right, raster_bounds.bottom),
-        (raster_bounds.left, raster_bounds.bottom)
-    ])
-    return MultiPolygon([poly for poly in multi_poly if poly.within(raster_poly)])
+    """
+    Parcels of multi_poly (or of a ParcelIndex built from it) completely
+    inside the raster bounds.
+    """
+    index = multi_poly if isinstance(multi_poly, ParcelIndex) else ParcelIndex(multi_poly)
+    return MultiPolygon([index.parcels[idx] for idx in index.within_bounds(raster_bounds)])
+
+
+def get_poly_intersecting(multi_poly, raster_bounds, clip=True):
+    """
+    Parcels of multi_poly (or of a ParcelIndex built from it) intersecting the
+    raster bounds, as a list of (index, geometry). With clip, parcels that
+    straddle the tile edge are clipped to the raster.
+    """
+    index = multi_poly if isinstance(multi_poly, ParcelIndex) else ParcelIndex(multi_poly)
+    return index.intersecting_bounds(raster_bounds, clip=clip)
 
 
 def lonlat_to_utm(dataset_crs, lon, lat):
     """
-    Transform lon and lat to utm coordinates
+    Transform lon and lat (scalars or arrays) to utm coordinates
     """
-    utm = pyproj.Proj(dataset_crs) # Pass CRS of image from rasterio
-    lonlat = pyproj.Proj(init='epsg:4326')
-    return pyproj.transform(lonlat, utm, lon, lat)
+    return transform_coords(WGS84, dataset_crs, lon, lat)  # Pass CRS of image from rasterio
 
 
 def get_subset_raster(tiff_url, east1, north1, east2, north2):
@@ -47,22 +86,170 @@ def ndvi_calculation(param):
     band_08 = get_subset_raster(param['band_08'], bounds[0], bounds[1], bounds[2], bounds[3])
     nir = band_08.astype('float32')
     red = band_04.astype('float32')
-    np.seterr(divide='ignore', invalid='ignore')
-    ndvi = np.where(
-        (nir + red) == 0.,
-        0,
-        (nir - red) / (nir + red))
+    ndvi = compute_ndvi(red, nir)
     return red, nir, ndvi
 
 
+class BlockReader:
+    """
+    Read arbitrary windows of a raster band through a cache of its internal
+    blocks, so every block is fetched from the (remote) COG only once.
+    """
+    def __init__(self, src, bidx=1):
+        self.src = src
+        self.bidx = bidx
+        self.block_height, self.block_width = src.block_shapes[bidx - 1]
+        self.blocks = {}
+
+    def _block(self, i, j):
+        if (i, j) not in self.blocks:
+            window = self.src.block_window(self.bidx, i, j)
+            self.blocks[(i, j)] = self.src.read(self.bidx, window=window)
+        return self.blocks[(i, j)]
+
+    def read(self, row_start, row_stop, col_start, col_stop):
+        out = np.zeros((row_stop - row_start, col_stop - col_start), dtype=self.src.dtypes[self.bidx - 1])
+        for i in range(row_start // self.block_height, (row_stop - 1) // self.block_height + 1):
+            for j in range(col_start // self.block_width, (col_stop - 1) // self.block_width + 1):
+                block = self._block(i, j)
+                r0, c0 = i * self.block_height, j * self.block_width
+                r1, r2 = max(row_start, r0), min(row_stop, r0 + block.shape[0])
+                c1, c2 = max(col_start, c0), min(col_stop, c0 + block.shape[1])
+                out[r1 - row_start:r2 - row_start, c1 - col_start:c2 - col_start] = block[r1 - r0:r2 - r0, c1 - c0:c2 - c0]
+        return out
+
+    def evict_rows_before(self, row):
+        """
+        Drop the cached blocks that lie completely above the given pixel row.
+        """
+        first_block_row = row // self.block_height
+        for key in [key for key in self.blocks if key[0] < first_block_row]:
+            del self.blocks[key]
+
+
+def get_polygon_window(src, polygon):
+    """
+    Pixel window (row_start, row_stop, col_start, col_stop) of the polygon
+    bounds, clipped to the raster.
+    """
+    minx, miny, maxx, maxy = polygon.bounds
+    row1, col1 = src.index(minx, maxy)
+    row2, col2 = src.index(maxx, miny)
+    row1, row2 = max(row1, 0), min(row2, src.height)
+    col1, col2 = max(col1, 0), min(col2, src.width)
+    return row1, max(row1, row2), col1, max(col1, col2)
+
+
+def ndvi_statistics(ndvi, mask):
+    # Only finite values count: nodata and undefined NDVI are NaN
+    values = ndvi[mask & np.isfinite(ndvi)]
+    if values.size == 0:
+        return {'count': 0, 'mean': None, 'median': None, 'std': None, 'min': None, 'max': None}
+    return {
+        'count': int(values.size),
+        'mean': float(values.mean()),
+        'median': float(np.median(values)),
+        'std': float(values.std()),
+        'min': float(values.min()),
+        'max': float(values.max()),
+    }
+
+
+def ndvi_calculation_batch(band_04_url, band_08_url, polygons, stats=False, polygons_crs=None):
+    """
+    NDVI of many polygons, reading every COG block of B04 and B08 only once.
+
+    Polygons (shapely geometries or GeoJSON-like dicts, in the raster CRS
+    unless polygons_crs is given) are processed in the order of the blocks
+    they touch, and cached blocks are released once no pending polygon needs
+    them. Returns, in the input order, a (red, nir, ndvi) tuple per polygon
+    like ndvi_calculation or, with stats=True, a dict of NDVI statistics over
+    the valid pixels inside the polygon (nodata pixels and pixels where
+    red + nir is 0 are left out).
+    """
+    polygons = [shape(p) if isinstance(p, dict) else p for p in polygons]
+    results = [None] * len(polygons)
+    with rasterio.open(band_04_url) as src_04, rasterio.open(band_08_url) as src_08:
+        if polygons_crs is not None:
+            polygons = transform_geometries(polygons_crs, src_04.crs, polygons)
+        reader_04 = BlockReader(src_04)
+        reader_08 = BlockReader(src_08)
+        windows = [get_polygon_window(src_04, p) for p in polygons]
+        for idx in sorted(range(len(polygons)), key=lambda k: (windows[k][0], windows[k][2])):
+            row_start, row_stop, col_start, col_stop = windows[idx]
+            reader_04.evict_rows_before(row_start)
+            reader_08.evict_rows_before(row_start)
+            if row_stop == row_start or col_stop == col_start:
+                empty = np.zeros((row_stop - row_start, col_stop - col_start), dtype='float32')
+                results[idx] = ndvi_statistics(empty, empty.astype(bool)) if stats else (empty, empty, empty)
+                continue
+            red = reader_04.read(row_start, row_stop, col_start, col_stop)
+            nir = reader_08.read(row_start, row_stop, col_start, col_stop)
+            if stats:
+                ndvi = compute_ndvi(red, nir, nodata=src_04.nodata, fill=np.nan)
+                window = rasterio.windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+                mask = geometry_mask([polygons[idx]], out_shape=ndvi.shape,
+                                     transform=src_04.window_transform(window), invert=True)
+                results[idx] = ndvi_statistics(ndvi, mask)
+            else:
+                ndvi = compute_ndvi(red, nir)
+                results[idx] = (red.astype('float32'), nir.astype('float32'), ndvi)
+    return results
+
+
 def ndvi_tile_sentinel(band_04_url, band_08_url):
     with rasterio.open(band_04_url) as dataset:
         red = dataset.read(1).astype('float32')
     with rasterio.open(band_08_url) as dataset:
         nir = dataset.read(1).astype('float32')
-    np.seterr(divide='ignore', invalid='ignore')
-    ndvi = np.where(
-        (nir + red) == 0.,
-        0,
-        (nir - red) / (nir + red))
-    return red, nir, ndvi
\ No newline at end of file
+    ndvi = compute_ndvi(red, nir)
+    return red, nir, ndvi
+
+
+def ndvi_to_cog(band_04_url, band_08_url, dst_path, scale=None, blocksize=512):
+    """
+    Stream the NDVI of a whole tile into a tiled, compressed COG with overviews.
+
+    NDVI is computed block by block, so peak memory is a few blocks instead of
+    the full bands. Invalid pixels are written as nodata (NaN, or -32768 for
+    the int16 output produced with scale, e.g. NDVI_SCALE, which is also
+    stored in the NDVI_SCALE tag).
+    """
+    nodata = np.nan if scale is None else -32768
+    with rasterio.open(band_04_url) as red_src, rasterio.open(band_08_url) as nir_src:
+        profile = {
+            'driver': 'GTiff',
+            'dtype': 'float32' if scale is None else 'int16',
+            'count': 1,
+            'width': red_src.width,
+            'height': red_src.height,
+            'crs': red_src.crs,
+            'transform': red_src.transform,
+            'nodata': nodata,
+            'tiled': True,
+            'blockxsize': blocksize,
+            'blockysize': blocksize,
+            'compress': 'DEFLATE',
+        }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp_path = os.path.join(tmpdir, 'ndvi.tif')
+            with rasterio.open(tmp_path, 'w', **profile) as dst:
+                for _, window in dst.block_windows(1):
+                    red = red_src.read(1, window=window)
+                    nir = nir_src.read(1, window=window)
+                    ndvi = compute_ndvi(red, nir, nodata=red_src.nodata, scale=scale, fill=nodata)
+                    dst.write(ndvi, 1, window=window)
+                if scale is not None:
+                    dst.update_tags(NDVI_SCALE=scale)
+
+            output_profile = cog_profiles.get('deflate')
+            output_profile.update(blockxsize=blocksize, blockysize=blocksize)
+            cog_translate(
+                tmp_path,
+                dst_path,
+                output_profile,
+                in_memory=False,
+                config=dict(GDAL_TIFF_OVR_BLOCKSIZE=blocksize),
+                quiet=True,
+            )
+    return dst_path
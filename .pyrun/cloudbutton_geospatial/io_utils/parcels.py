@@ -0,0 +1,74 @@
+import numpy as np
+from shapely.geometry import box
+from shapely.prepared import prep
+
+
+class ParcelIndex:
+    """
+    Bounding-box index over a collection of parcels (shapely geometries).
+
+    Parcel bounds are kept in a (n, 4) array, so candidate selection is a
+    vectorized comparison instead of a geometry test per parcel. Exact
+    geometry tests are only run for the parcels that cross the query border.
+    Build it once and query it for every raster tile or study area.
+    """
+    def __init__(self, parcels):
+        self.parcels = list(getattr(parcels, 'geoms', parcels))
+        self.bounds = np.array(
+            [p.bounds if not p.is_empty else (np.nan,) * 4 for p in self.parcels],
+            dtype='float64').reshape(-1, 4)
+
+    def __len__(self):
+        return len(self.parcels)
+
+    def candidates(self, bounds):
+        """
+        Indices of the parcels whose bounding box intersects bounds
+        (minx, miny, maxx, maxy or a rasterio BoundingBox).
+        """
+        minx, miny, maxx, maxy = bounds
+        b = self.bounds
+        return np.flatnonzero((b[:, 0] <= maxx) & (b[:, 2] >= minx) & (b[:, 1] <= maxy) & (b[:, 3] >= miny))
+
+    def within_bounds(self, bounds):
+        """
+        Indices of the parcels completely inside bounds.
+        """
+        minx, miny, maxx, maxy = bounds
+        b = self.bounds
+        return np.flatnonzero((b[:, 0] >= minx) & (b[:, 2] <= maxx) & (b[:, 1] >= miny) & (b[:, 3] <= maxy))
+
+    def clip(self, geometry):
+        """
+        Parcels intersecting geometry as a list of (index, geometry). Parcels
+        inside geometry are returned as they are and parcels crossing its
+        border are clipped to it.
+        """
+        prepared = prep(geometry)
+        selected = []
+        for idx in self.candidates(geometry.bounds):
+            parcel = self.parcels[idx]
+            if prepared.contains(parcel):
+                selected.append((idx, parcel))
+            elif prepared.intersects(parcel):
+                clipped = parcel.intersection(geometry)
+                if not clipped.is_empty:
+                    selected.append((idx, clipped))
+        return selected
+
+    def intersecting_bounds(self, bounds, clip=True):
+        """
+        Parcels intersecting bounds as a list of (index, geometry). With clip,
+        parcels straddling the border are clipped to bounds.
+        """
+        minx, miny, maxx, maxy = bounds
+        inside = set(self.within_bounds(bounds).tolist())
+        area = box(minx, miny, maxx, maxy)
+        selected = []
+        for idx in self.candidates(bounds):
+            parcel = self.parcels[idx]
+            if idx in inside:
+                selected.append((idx, parcel))
+            elif parcel.intersects(area):
+                selected.append((idx, parcel.intersection(area) if clip else parcel))
+        return selected
@@ -2,7 +2,16 @@ from matplotlib import pyplot as plt
 from ibm_botocore.client import Config, ClientError
 import rasterio
 import random
+import threading
 import ibm_boto3
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+COS_ENDPOINT = "https://s3.eu-de.cloud-object-storage.appdomain.cloud"
+
+# Rendered thumbnails by (endpoint_url, bucket, item, max_size)
+_thumbnails = {}
+_thumbnails_lock = threading.Lock()
 
 def plot_random_blocks(bucket, item, num):
     """
@@ -12,7 +21,7 @@ def plot_random_blocks(bucket, item, num):
     fig, axs = plt.subplots(num, figsize=(20,30))
     cos = ibm_boto3.resource("s3",
                              config=Config(signature_version="oauth"),
-                             endpoint_url="https://s3.eu-de.cloud-object-storage.appdomain.cloud"
+                             endpoint_url=COS_ENDPOINT
                              )
     obj = cos.Object(bucket, item)
     with rasterio.open(obj.get()['Body']) as src:
@@ -25,27 +34,76 @@ def plot_random_blocks(bucket, item, num):
             plt.colorbar(shrink=0.5)
     plt.show()
 
-def plot_results(bucket, results):
+def cos_env(endpoint_url=COS_ENDPOINT, access_key_id=None, secret_access_key=None):
+    """
+    GDAL environment to read COS items through /vsis3/ with HMAC credentials.
+    Without them GDAL takes AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY or
+    ~/.aws/credentials
+    """
+    endpoint = urlparse(endpoint_url)
+    options = dict(
+        AWS_S3_ENDPOINT=endpoint.netloc or endpoint.path,
+        AWS_HTTPS='NO' if endpoint.scheme == 'http' else 'YES',
+        AWS_VIRTUAL_HOSTING='FALSE',
+        GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR',
+        CPL_VSIL_CURL_ALLOWED_EXTENSIONS='.tif,.tiff',
+    )
+    if access_key_id and secret_access_key:
+        options.update(AWS_ACCESS_KEY_ID=access_key_id, AWS_SECRET_ACCESS_KEY=secret_access_key)
+    return rasterio.Env(**options)
+
+def get_thumbnail(bucket, item, max_size=512, endpoint_url=COS_ENDPOINT, access_key_id=None, secret_access_key=None):
+    """
+    Thumbnail of a COG item, read from its smallest overview that is still at
+    least max_size pixels wide through authenticated range requests.
+    Thumbnails are cached in memory.
+    """
+    key = (endpoint_url, bucket, item, max_size)
+    with _thumbnails_lock:
+        if key in _thumbnails:
+            return _thumbnails[key]
+
+    url = f"/vsis3/{bucket}/{item}"
+    with cos_env(endpoint_url, access_key_id, secret_access_key):
+        with rasterio.open(url) as src:
+            size = max(src.width, src.height)
+            # list of overviews from biggest to smallest
+            levels = [i for i, factor in enumerate(src.overviews(1)) if size / factor >= max_size]
+            if not levels:
+                scale = max(1, size // max_size)
+                thumbnail = src.read(1, out_shape=(max(1, src.height // scale), max(1, src.width // scale)))
+        if levels:
+            with rasterio.open(url, overview_level=levels[-1]) as src:
+                thumbnail = src.read(1)
+
+    with _thumbnails_lock:
+        _thumbnails[key] = thumbnail
+    return thumbnail
+
+def get_thumbnails(bucket, items, max_size=512, endpoint_url=COS_ENDPOINT, workers=16,
+                   access_key_id=None, secret_access_key=None):
+    """
+    Fetch the thumbnails of many COS items concurrently
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(
+            lambda item: get_thumbnail(bucket, item, max_size, endpoint_url, access_key_id, secret_access_key),
+            items))
+
+def plot_results(bucket, results, max_size=512, endpoint_url=COS_ENDPOINT, access_key_id=None, secret_access_key=None):
     """
     Plot an array of COS from IBM Cloud
     """
     size = len(results)
     fig, axs = plt.subplots(len(results), figsize=(20,30))
 
-    cos = ibm_boto3.resource("s3",
-                             config=Config(signature_version="oauth"),
-                             endpoint_url="https://s3.eu-de.cloud-object-storage.appdomain.cloud"
-                             )
-    i = 1
-    for item in results:
-        obj = cos.Object(bucket, item)
-        with rasterio.open(obj.get()['Body']) as src:
-            arr = src.read(1, out_shape=(src.height//10, src.width//10))
-            plt.subplot(1 + (size-1)/2, 2, i)
-            plt.gca().set_title(item)
-            plt.imshow(arr)
-            plt.colorbar(shrink=0.5)
-            i += 1
+    thumbnails = get_thumbnails(bucket, results, max_size, endpoint_url,
+                                access_key_id=access_key_id, secret_access_key=secret_access_key)
+    for i, (item, arr) in enumerate(zip(results, thumbnails), start=1):
+        plt.subplot(1 + (size-1)/2, 2, i)
+        plt.gca().set_title(item)
+        plt.imshow(arr)
+        plt.colorbar(shrink=0.5)
     
     plt.show()
 
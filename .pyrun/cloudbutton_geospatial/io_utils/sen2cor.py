@@ -1,62 +1,194 @@
 import glob
-from io_utils.sentinel import jp2_to_cog
+from concurrent.futures import ThreadPoolExecutor
+from .sentinel import convert_bands_to_cog
+import numpy as np
 import os
 import rasterio
+import re
+from rio_cogeo.cogeo import cog_translate
+from rio_cogeo.profiles import cog_profiles
+import shlex
 import subprocess
+import tempfile
 
-def perform_atmospheric_corrections(product):
-    sentinel_product_dir = product['filename']
-    date = product['filename'][11:19]
-    tile = product['filename'][39:44]
-    corrected_images = glob.glob(f"*2A_{date}*_T{tile}_*.SAFE/GRANULE/*/IMG_DATA/R10m/*B0[48]*.jp2")
-    atmospheric_corrected = corrected_images[0] if len(corrected_images) > 0 else None
-    # Atmospheric correction
-    if (not atmospheric_corrected):  
-        print(f'Doing the atmospheric correction for {sentinel_product_dir}')
-        val = subprocess.check_call(f'{os.environ["SEN2COR_COM"]} --resolution 10 {sentinel_product_dir}', shell=True)
-        corrected_images = glob.glob(f"*2A_{date}*_T{tile}_*.SAFE/GRANULE/*/IMG_DATA/R10m/*B0[48]*.jp2")
+SAFE_NAME = re.compile(r'S2[AB]_MSIL(?P<level>1C|2A)_(?P<date>\d{8})T\d{6}_N\d{4}_R\d{3}_T(?P<tile>\w{5})_\w+\.SAFE$')
+# Peak memory of a Sen2Cor run at 10 m resolution
+SEN2COR_MEMORY = 4 * 1024 ** 3
+
+
+def index_safe_products(products_dir='.'):
+    """
+    Index the SAFE directories of products_dir by (level, tile, date), where
+    level is '1C' or '2A'. Each key maps to the list of matching directories.
+    """
+    index = {}
+    for name in sorted(os.listdir(products_dir)):
+        match = SAFE_NAME.match(name)
+        path = os.path.join(products_dir, name)
+        if match and os.path.isdir(path):
+            key = (match.group('level'), match.group('tile'), match.group('date'))
+            index.setdefault(key, []).append(path)
+    return index
+
+
+def l2a_complete(l2a_dir, bands=('B04', 'B08')):
+    """
+    True if the L2A product has the 10 m images of all the bands. An
+    interrupted Sen2Cor run leaves the SAFE directory without them.
+    """
+    return all(glob.glob(os.path.join(l2a_dir, 'GRANULE', '*', 'IMG_DATA', 'R10m', f'*{band}*.jp2'))
+               for band in bands)
+
+
+def find_l2a(index, tile, date, bands=('B04', 'B08')):
+    for l2a_dir in index.get(('2A', tile, date), []):
+        if l2a_complete(l2a_dir, bands):
+            return l2a_dir
+    return None
+
+
+def sen2cor_workers(workers=None, memory_per_process=SEN2COR_MEMORY):
+    """
+    Number of concurrent Sen2Cor runs that fit in the CPUs and the available
+    memory of this machine.
+    """
+    limit = os.cpu_count() or 1
+    try:
+        available = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+        limit = min(limit, available // memory_per_process)
+    except (AttributeError, ValueError, OSError):
+        pass
+    return max(1, min(workers or limit, limit))
+
+
+def run_atmospheric_corrections(l1c_dirs, command=None, workers=None, memory_per_process=SEN2COR_MEMORY,
+                                bands=('B04', 'B08')):
+    """
+    Atmospheric correction of many MSIL1C products with Sen2Cor, several of
+    them at a time. Products whose L2A output is already complete are
+    skipped. The outputs are looked up by tile and date in the directory of
+    each product, where Sen2Cor writes them.
+
+    command is the L2A_Process command line, SEN2COR_COM by default. It is
+    run without a shell. Returns a dict mapping every L1C directory to its
+    L2A directory.
+    """
+    command = shlex.split(command or os.environ['SEN2COR_COM'])
+    indexes = {}
+
+    def lookup(l1c_dir, refresh=False):
+        products_dir = os.path.dirname(os.path.abspath(l1c_dir))
+        if refresh or products_dir not in indexes:
+            indexes[products_dir] = index_safe_products(products_dir)
+        match = SAFE_NAME.match(os.path.basename(os.path.normpath(l1c_dir)))
+        if not match:
+            raise Exception(f'{l1c_dir} is not a Sentinel-2 SAFE product')
+        return find_l2a(indexes[products_dir], match.group('tile'), match.group('date'), bands)
+
+    corrected = {l1c_dir: lookup(l1c_dir) for l1c_dir in l1c_dirs}
+    pending = [l1c_dir for l1c_dir, l2a_dir in corrected.items() if l2a_dir is None]
+    for l1c_dir, l2a_dir in corrected.items():
+        if l2a_dir is not None:
+            print(f'Atmospheric correction of {l1c_dir} already done in {l2a_dir}')
+
+    def correct(l1c_dir):
+        print(f'Doing the atmospheric correction for {l1c_dir}')
+        val = subprocess.run(command + ['--resolution', '10', l1c_dir], check=True).returncode
         print(f'Atmospheric correction finished {val}')
-    corrected_folder = corrected_images[0][:corrected_images[0].index('.SAFE')+len('.SAFE')]
-    return corrected_folder
 
-def generate_bands(product):
-    files = []
+    if pending:
+        with ThreadPoolExecutor(max_workers=sen2cor_workers(workers, memory_per_process)) as executor:
+            list(executor.map(correct, pending))
+        for l1c_dir in pending:
+            corrected[l1c_dir] = lookup(l1c_dir, refresh=True)
+            if corrected[l1c_dir] is None:
+                raise Exception(f'Sen2Cor did not generate the L2A product of {l1c_dir}')
+    return corrected
+
+
+def perform_atmospheric_corrections(product, command=None):
+    sentinel_product_dir = product['filename']
+    return run_atmospheric_corrections([sentinel_product_dir], command=command)[sentinel_product_dir]
+
+def find_bands(product, bands=('B04', 'B08')):
     sentinel_product_dir = product['filename']
-    # Translate bands in .jp2 to Cloud Optimized geoTiff format
     date = sentinel_product_dir[11:19]
     tile = sentinel_product_dir[39:44]
-    band4 = glob.glob(f"*L2A_{date}*_T{tile}*.SAFE/GRANULE/*/IMG_DATA/R10m/*B04*")
-    band4 = band4[0] if len(band4) == 1 else None
-    band8 = glob.glob(f"*L2A_{date}*_T{tile}*.SAFE/GRANULE/*/IMG_DATA/R10m/*B08*")
-    band8 = band8[0] if len(band8) == 1 else None
-    if band4 is not None and band8 is not None:
-        band4_tiff_file = f"{band4[band4.rfind('/')+1:band4.rfind('.')]}.tif"
-        band8_tiff_file = f"{band8[band8.rfind('/') + 1:band8.rfind('.')]}.tif"
-        jp2_to_cog(band4)
-        jp2_to_cog(band8)
-        files.append(band4_tiff_file)
-        files.append(band8_tiff_file)
-
-    return files
-
-def combine_bands(band_files):
+    found = []
+    for band in bands:
+        band_files = glob.glob(f"*L2A_{date}*_T{tile}*.SAFE/GRANULE/*/IMG_DATA/R10m/*{band}*")
+        if len(band_files) != 1:
+            return None
+        found.append(band_files[0])
+    return found
+
+def generate_bands(product):
+    # Translate bands in .jp2 to Cloud Optimized geoTiff format
+    files = generate_products_bands([product])
+    return files[0]
+
+def generate_products_bands(products, bands=('B04', 'B08'), dst_dir=None, cpu_budget=None, workers=None):
+    """
+    Translate the requested bands of many products to Cloud Optimized geoTiff
+    in a single process pool. Returns the list of COG files of each product
+    (empty if any of its bands is missing).
+    """
+    products_bands = [find_bands(product, bands) or [] for product in products]
+    timings = convert_bands_to_cog([band for product_bands in products_bands for band in product_bands],
+                                   dst_dir=dst_dir, cpu_budget=cpu_budget, workers=workers)
+    cogs = iter(timing['dst'] for timing in timings)
+    return [[next(cogs) for _ in product_bands] for product_bands in products_bands]
+
+def combine_bands(band_files, interleave='pixel', blocksize=512, workers=None):
+    """
+    Stack single band files into a tiled COG, block by block. The blocks of
+    all the bands are read concurrently and memory is bounded by the block
+    size. interleave is 'pixel' or 'band'.
+    """
 
     if len(band_files) <= 1:
         raise Exception('Invalid number of files')
+    if interleave not in ('pixel', 'band'):
+        raise Exception(f'Invalid interleave {interleave}')
 
     filename = band_files[0][0:22] + '_COMBINED.tif'
     if not os.path.exists(filename):
-        # Get metadata from first file
-        with rasterio.open(band_files[0]) as src:
-            profile = src.profile
-            profile.update(count=len(band_files))
+        srcs = [rasterio.open(band_file) for band_file in band_files]
+        try:
+            first = srcs[0]
+            for src in srcs[1:]:
+                if (src.width, src.height, src.transform) != (first.width, first.height, first.transform):
+                    raise Exception(f'{src.name} does not share the grid of {first.name}')
+            dtype = np.result_type(*[src.dtypes[0] for src in srcs])
+            profile = {
+                'driver': 'GTiff',
+                'dtype': dtype.name,
+                'count': len(srcs),
+                'width': first.width,
+                'height': first.height,
+                'crs': first.crs,
+                'transform': first.transform,
+                'nodata': first.nodata,
+                'tiled': True,
+                'blockxsize': blocksize,
+                'blockysize': blocksize,
+                'compress': 'DEFLATE',
+                'interleave': interleave,
+            }
+            with tempfile.TemporaryDirectory() as tmpdir:
+                tmp_filename = os.path.join(tmpdir, 'combined.tif')
+                with rasterio.open(tmp_filename, 'w', **profile) as dst, \
+                        ThreadPoolExecutor(max_workers=workers or len(srcs)) as executor:
+                    for _, window in dst.block_windows(1):
+                        # Each dataset is only used by one thread at a time
+                        blocks = list(executor.map(lambda src: src.read(1, window=window), srcs))
+                        dst.write(np.stack(blocks).astype(dtype, copy=False), window=window)
 
-
-        with rasterio.open(filename, 'w', **profile) as dst:
-            for i in range(len(band_files)):
-                with rasterio.open(band_files[i]) as src:
-                    dst.write(src.read(1), i + 1)
+                output_profile = cog_profiles.get('deflate')
+                output_profile.update(blockxsize=blocksize, blockysize=blocksize, interleave=interleave)
+                cog_translate(tmp_filename, filename, output_profile, in_memory=False, quiet=True)
+        finally:
+            for src in srcs:
+                src.close()
 
     return filename
-
-
@@ -5,8 +5,11 @@ import zipfile
 import subprocess
 import os
 import glob
+import time
+from concurrent.futures import ProcessPoolExecutor
 from rio_tiler.sentinel2 import _sentinel_parse_scene_id
-from rio_cogeo.cogeo import cog_translate
+from rio_cogeo.cogeo import cog_translate, cog_validate
+from ..datafetch_utils.sentinel import extract_bands
 
 def get_sentinel_metadata_from_area(from_date, to_date, geo_json_area, cloudcoverpercentage=(0, 15)):
     api = sentinelsat.SentinelAPI(user=os.environ["SENTINEL_USERNAME"],
@@ -20,11 +23,12 @@ def get_sentinel_metadata_from_area(from_date, to_date, geo_json_area, cloudcove
                          cloudcoverpercentage=cloudcoverpercentage)
     return products
 
-def jp2_to_cog(band_src_path):
+def jp2_to_cog(band_src_path, dst_dir=None, num_threads='ALL_CPUS'):
     '''
     Given the path of a band of sentinel (.jp2) generates a Cloud Optimized GeoTiff version.
+    The COG is written in dst_dir (current directory by default) and GDAL uses num_threads threads.
     '''
-    config = dict(NUM_THREADS=100, GDAL_TIFF_OVR_BLOCKSIZE=128)
+    config = dict(NUM_THREADS=num_threads, GDAL_TIFF_OVR_BLOCKSIZE=128)
 
     output_profile = {
         "driver": "GTiff",
@@ -36,6 +40,8 @@ def jp2_to_cog(band_src_path):
     }
 
     cog_path = f"{band_src_path[band_src_path.rfind('/')+1:band_src_path.rfind('.')]}.tif"
+    if dst_dir is not None:
+        cog_path = os.path.join(dst_dir, cog_path)
     cog_translate(
         band_src_path,
         cog_path,
@@ -47,6 +53,53 @@ def jp2_to_cog(band_src_path):
     )
     return cog_path
 
+def is_valid_cog(cog_path):
+    if not os.path.exists(cog_path):
+        return False
+    try:
+        return cog_validate(cog_path, quiet=True)[0]
+    except Exception:
+        return False
+
+def _convert_band(args):
+    band_src_path, dst_dir, num_threads = args
+    cog_path = f"{band_src_path[band_src_path.rfind('/')+1:band_src_path.rfind('.')]}.tif"
+    if dst_dir is not None:
+        cog_path = os.path.join(dst_dir, cog_path)
+    start = time.perf_counter()
+    skipped = is_valid_cog(cog_path)
+    if not skipped:
+        jp2_to_cog(band_src_path, dst_dir, num_threads)
+    return {
+        'src': band_src_path,
+        'dst': cog_path,
+        'skipped': skipped,
+        'seconds': time.perf_counter() - start,
+    }
+
+def convert_bands_to_cog(band_src_paths, dst_dir=None, cpu_budget=None, workers=None):
+    '''
+    Convert many bands (.jp2) to Cloud Optimized GeoTiff in a process pool.
+
+    The CPU budget (all CPUs by default) is split between the worker processes
+    and the internal GDAL threads of each one. Outputs that are already valid
+    COGs are skipped. Returns a dict per band with its src and dst paths,
+    whether it was skipped and the seconds it took, in the input order.
+    '''
+    band_src_paths = list(band_src_paths)
+    if not band_src_paths:
+        return []
+    cpu_budget = cpu_budget or os.cpu_count() or 1
+    workers = max(1, min(workers or cpu_budget, cpu_budget, len(band_src_paths)))
+    num_threads = max(1, cpu_budget // workers)
+    tasks = [(band, dst_dir, num_threads) for band in band_src_paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        timings = list(executor.map(_convert_band, tasks))
+    for timing in timings:
+        status = 'skipped' if timing['skipped'] else f"{timing['seconds']:.1f}s"
+        print(f"COG {timing['dst']}: {status}")
+    return timings
+
 def download_unzip_transform_to_geotiff(product):
     api = sentinelsat.SentinelAPI(user=os.environ["SENTINEL_USERNAME"],
                                   password=os.environ["SENTINEL_PASSWORD"])
@@ -73,7 +126,12 @@ def download_unzip_transform_to_geotiff(product):
         upload_band_file(band4_tiff_file, product)
         upload_band_file(band8_tiff_file, product)
 
-def download_from_sentinel(product, tmpdir):
+def download_from_sentinel(product, tmpdir, bands=None):
+    '''
+    Download a product and unzip it in tmpdir. With bands (e.g. ('B04', 'B08'))
+    only those band images are extracted, but the atmospheric correction needs
+    the whole product.
+    '''
     api = sentinelsat.SentinelAPI(user=os.environ["SENTINEL_USERNAME"],
                                   password=os.environ["SENTINEL_PASSWORD"])
 
@@ -81,9 +139,12 @@ def download_from_sentinel(product, tmpdir):
     if not os.path.exists(sentinel_product_dir):
         d_meta = api.download(product['uuid'], directory_path=tmpdir)
         # Extract and remove zip file
-        zip_ref = zipfile.ZipFile(d_meta['path'])
-        zip_ref.extractall(tmpdir)
-        zip_ref.close()
+        if bands:
+            extract_bands(d_meta['path'], tmpdir, bands)
+        else:
+            zip_ref = zipfile.ZipFile(d_meta['path'])
+            zip_ref.extractall(tmpdir)
+            zip_ref.close()
         os.remove(d_meta['path'])
     return sentinel_product_dir
 
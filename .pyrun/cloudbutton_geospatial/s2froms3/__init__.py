@@ -4,6 +4,9 @@
 
 from .download import download_S2, get_scene_list
 from . import products
-from .utils import point_in_tile
+from .utils import point_in_tile, lonlat_to_tile, neighbour_tiles
+from .stack import BandStack, stacks_from_scene_list
+from .masks import clear_windows, window_quality
+from .composite import composite, composite_ndvi
 
 __version__ = "0.3.0"
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming temporal composites of multi-date scene stacks.
+
+The composite is computed window by window: every window is read from every
+date, reduced along the time axis and written to the output before moving to
+the next one. Memory is bounded by window size x number of dates and never by
+tile size. Dates whose window is cloudy or empty according to the SCL
+overview pre-pass (see ``masks``) are skipped without reading their bands.
+"""
+
+import warnings
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Union
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from ..io_utils.ndvi import compute_ndvi
+from .masks import scl_mask, window_quality
+from .stack import BandStack
+
+REDUCERS = {
+    "median": np.nanmedian,
+    "max": np.nanmax,
+    "min": np.nanmin,
+    "mean": np.nanmean,
+}
+
+Reducer = Union[str, Callable[..., np.ndarray]]
+
+
+def _get_reducer(reducer: Reducer) -> Callable[..., np.ndarray]:
+    if callable(reducer):
+        return reducer
+    if reducer not in REDUCERS:
+        raise ValueError(
+            f"{reducer} is not a valid reducer. Valid values are {list(REDUCERS)}"
+        )
+    return REDUCERS[reducer]
+
+
+def ndvi_window(stack: BandStack, window: Window, mask_clouds: bool = True) -> np.ndarray:
+    """NDVI of a window of a stack as float32, NaN where it is undefined or,
+    if `mask_clouds` and the stack has an SCL band, cloudy."""
+    red = stack.read_band("B04", window)
+    nir = stack.read_band("B08", window)
+    ndvi = compute_ndvi(red, nir, fill=np.nan)
+    if mask_clouds and "SCL" in stack.paths:
+        ndvi[scl_mask(stack.read_band("SCL", window))] = np.nan
+    return ndvi
+
+
+def composite(
+    stacks: Sequence[BandStack],
+    dst_path: Union[str, Path],
+    compute: Callable[[BandStack, Window], np.ndarray],
+    reducer: Reducer = "median",
+    window_size: int = 512,
+    max_invalid: Optional[float] = None,
+) -> str:
+    """Reduce a per-date quantity along the time axis, window by window.
+
+    Parameters
+    ----------
+    stacks: array_like
+        One ``BandStack`` per date. All of them must share the same grid,
+        i.e. belong to the same tile.
+    dst_path: str or Path
+        Path of the float32 GeoTIFF to write.
+    compute: callable
+        Function receiving a stack and a window and returning a float32 array
+        of the window, with NaN for pixels that have to be ignored.
+    reducer: str or callable
+        'median', 'max', 'min', 'mean' or a NumPy-like reducer accepting an
+        `axis` keyword. Default value is 'median'.
+    window_size: int
+        Size of the square windows, multiple of 16. Default value is 512.
+    max_invalid: float or None
+        Dates with an SCL band whose window has at least this fraction of
+        cloud, shadow and no-data pixels in the SCL overview are left as NaN
+        without calling `compute`. 1.0 only skips fully invalid windows.
+        Default value is None, which computes every window.
+
+    Returns
+    -------
+    str
+        The path of the composite.
+    """
+    if not stacks:
+        raise ValueError("At least one stack is required")
+    if window_size % 16:
+        raise ValueError("`window_size` has to be a multiple of 16")
+    reduce = _get_reducer(reducer)
+    first = stacks[0]
+    for stack in stacks[1:]:
+        if (stack.crs, stack.transform, stack.width, stack.height) != (
+            first.crs, first.transform, first.width, first.height
+        ):
+            raise ValueError("All the stacks have to share the same grid")
+
+    profile = {
+        "driver": "GTiff",
+        "dtype": "float32",
+        "count": 1,
+        "width": first.width,
+        "height": first.height,
+        "crs": first.crs,
+        "transform": first.transform,
+        "nodata": np.nan,
+        "tiled": True,
+        "blockxsize": window_size,
+        "blockysize": window_size,
+        "compress": "DEFLATE",
+    }
+    windows = list(first.block_windows(window_size))
+    # One cheap SCL overview read per date instead of band reads per window
+    skip = [[False] * len(windows) for _ in stacks]
+    if max_invalid is not None:
+        for i, stack in enumerate(stacks):
+            if "SCL" in stack.paths:
+                quality = window_quality(stack, windows)
+                skip[i] = [q.invalid >= max_invalid for q in quality]
+
+    with rasterio.open(dst_path, "w", **profile) as dst:
+        for w, window in enumerate(windows):
+            block = np.full(
+                (len(stacks), int(window.height), int(window.width)),
+                np.nan,
+                dtype="float32",
+            )
+            for i, stack in enumerate(stacks):
+                if not skip[i][w]:
+                    block[i] = compute(stack, window)
+            with warnings.catch_warnings():
+                # All-NaN pixels (e.g. always cloudy) stay NaN
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                result = reduce(block, axis=0)
+            dst.write(result.astype("float32", copy=False), 1, window=window)
+    return str(dst_path)
+
+
+def composite_ndvi(
+    scenes: List[Sequence[str]],
+    dst_path: Union[str, Path],
+    reducer: Reducer = "median",
+    window_size: int = 512,
+    mask_clouds: bool = True,
+) -> str:
+    """Per-pixel NDVI composite of the scenes returned by ``get_scene_list``.
+
+    The scenes must contain 'B04' and 'B08' and, to mask clouds, 'SCL'. With
+    `mask_clouds`, dates whose window is fully invalid in the SCL overview
+    are skipped before reading B04 and B08. See ``composite`` for the rest of
+    the parameters."""
+    stacks = [BandStack(scene, resolution=10) for scene in scenes]
+    try:
+        return composite(
+            stacks,
+            dst_path,
+            lambda stack, window: ndvi_window(stack, window, mask_clouds),
+            reducer,
+            window_size,
+            max_invalid=1.0 if mask_clouds else None,
+        )
+    finally:
+        for stack in stacks:
+            stack.close()
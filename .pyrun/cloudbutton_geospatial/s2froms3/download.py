@@ -14,12 +14,14 @@ from concurrent.futures import ThreadPoolExecutor
 from itertools import cycle
 from time import sleep
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
-import mgrs  # type: ignore
 import s3fs  # type: ignore
 
-from .utils import _iter_dates
+from .utils import NEIGHBOURS, _iter_dates, lonlat_to_tile, neighbour_tiles
 from .products import Properties
+from .scheduler import AdaptiveScheduler
 
 CPU_COUNT = os.cpu_count()
 
@@ -74,16 +76,6 @@ def get_scene_list(
           |SW   |  S  |   SE|
           +-----+-----+-----+
     """
-    _also = {
-        "N": {"x": 0, "y": 150_000},
-        "NE": {"x": 150_000, "y": 150_000},
-        "E": {"x": 150_000, "y": 0},
-        "SE": {"x": 150_000, "y": -150_000},
-        "S": {"x": 0, "y": -150_000},
-        "SW": {"x": -150_000, "y": -150_000},
-        "W": {"x": -150_000, "y": 0},
-        "NW": {"x": -150_000, "y": 150_000},
-    }
     if start_date > end_date:
         raise ValueError("`start_date` has to be lower or equal than `end_date`")
     if isinstance(what, str):
@@ -99,12 +91,14 @@ def get_scene_list(
 
     rpaths = []
 
-    path: Union[str, Path]
-    m = mgrs.MGRS()
-
-    # Get the remote and local paths for the original target
-    coord = m.toMGRS(lat, lon, MGRSPrecision=0)
-    number, a, b = coord[:-3], coord[-3:-2], coord[-2:]
+    # Get the original target and the adjacent tiles, if required
+    coord = str(lonlat_to_tile(lon, lat)[0])
+    if also is None:
+        also = []
+    for al in also:
+        if al.upper() not in NEIGHBOURS:
+            raise ValueError(f'"{al.upper()}" is not a valid value for `also` keyword')
+    tiles = [coord] + list(neighbour_tiles(coord, also).values())
 
     def check_tile(_c):
         name = _c.split("/")[-1]
@@ -127,40 +121,11 @@ def get_scene_list(
                 exe.submit(check_tile, _c)
 
     with ThreadPoolExecutor() as ex:
-        for yy, mm in _iter_dates(start_date, end_date):
-            path = f"sentinel-cogs/sentinel-s2-l2a-cogs/{number}/{a}/{b}/{yy}/{mm}"
-            ex.submit(check_package, path)
-
-    # Get the remote and local paths for the adjacent COGS to the target,
-    # if required
-    # TODO (josep) make it threaded as before
-    if also is None:
-        also = []
-    for al in also:
-        al = al.upper()
-        if al not in list(_also.keys()):
-            raise ValueError(f'"{al}" is not a valid value for `also` keyword')
-        z, hem, x, y = m.MGRSToUTM(coord)
-        x += _also[al]["x"]
-        y += _also[al]["y"]
-        _coord = m.UTMToMGRS(z, hem, x, y, MGRSPrecision=0)
-        number, a, b = _coord[:-3], _coord[-3:-2], _coord[-2:]
-        for yy, mm in _iter_dates(start_date, end_date):
-            path = "sentinel-cogs/sentinel-s2-l2a-cogs/" f"{number}/{a}/{b}/{yy}/{mm}"
-            _contents = fs.ls(path)
-            for _c in _contents:
-                name = _c.split("/")[-1]
-                info = _c + "/" + name + ".json"
-                with fs.open(info, "r") as f:
-                    info = json.load(f)
-                date_str = name.split("_")[2]
-                cc = info["properties"]["eo:cloud_cover"]
-                date = dt.datetime.strptime(date_str, "%Y%m%d").date()
-                if cloud_cover_le >= cc and start_date <= date <= end_date:
-                    package = []
-                    for w in what:
-                        package.append(str(_c + f"/{w}.tif"))
-                    rpaths.append(tuple(package))
+        for tile in tiles:
+            number, a, b = tile[:-3], tile[-3:-2], tile[-2:]
+            for yy, mm in _iter_dates(start_date, end_date):
+                path = f"sentinel-cogs/sentinel-s2-l2a-cogs/{number}/{a}/{b}/{yy}/{mm}"
+                ex.submit(check_package, path)
 
     if not rpaths:
         raise Exception('No data found')
@@ -171,7 +136,10 @@ def get_scene_list(
 def download_S2(
     scenes: List[str],
     folder: Union[str, Path] = Path.home(),
-    workers: int = CPU_COUNT,
+    workers: Optional[int] = None,
+    max_workers: int = 64,
+    endpoint_url: Optional[str] = None,
+    part_concurrency: int = 4,
 ) -> List[str]:
     """Download Sentinel 2 COG (Cloud Optimized GeoTiff) images from Amazon S3.
 
@@ -187,8 +155,18 @@ def download_S2(
     folder: str or Path
         Where to download the data. The folder must exist. Default value is
         the home directory of the user.
-    workers: int
-        Number of parallel downloads using threading. Default value is 4.
+    workers: int or None
+        Fixed number of parallel downloads using threading. Default value is
+        None, which adapts the number of in-flight downloads to the measured
+        throughput and error rate (see `AdaptiveScheduler`).
+    max_workers: int
+        Upper bound of parallel downloads when adapting. Default value is 64.
+    endpoint_url: str or None
+        S3 endpoint, e.g. a local S3-compatible server for benchmarking.
+        Default value is None (Amazon S3).
+    part_concurrency: int
+        Parallel ranged requests per file. The connection pool is sized to
+        `max_workers * part_concurrency`. Default value is 4.
 
     Returns
     -------
@@ -205,17 +183,34 @@ def download_S2(
             lpath = f'{folder}/{path[1]}_{path[2]}'
             lpaths.append(lpath)
 
-    s3 = boto3.client('s3')
-
-    def get_file(rpath: Union[str, Path], lpath: Union[str, Path]) -> None:
+    if workers is None:
+        scheduler = AdaptiveScheduler(max_workers=max_workers, progressive=True)
+    else:
+        scheduler = AdaptiveScheduler(
+            min_workers=workers, max_workers=workers, progressive=True
+        )
+
+    # Every in-flight file uses up to part_concurrency connections
+    transfer_config = TransferConfig(max_concurrency=part_concurrency)
+    s3 = boto3.client(
+        's3',
+        endpoint_url=endpoint_url,
+        config=Config(max_pool_connections=scheduler.max_workers * part_concurrency),
+    )
+
+    def get_file(rpath: Union[str, Path], lpath: Union[str, Path]) -> int:
         bucket, obj = rpath.split('/', 1)
-        s3.download_file(bucket, obj, lpath)
-
-    executor = ThreadPoolExecutor(max_workers=workers)
-    ex = [executor.submit(get_file, rp, lp) for rp, lp in zip(rpaths, lpaths)]
-    cy = cycle(r"-\|/")
-    while not all([exx.done() for exx in ex]):
-        print("Downloading data " + next(cy), end="\r")
-        sleep(0.1)
+        s3.download_file(
+            bucket, obj, lpath, Config=transfer_config, Callback=scheduler.progress
+        )
+        return os.path.getsize(lpath)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        job = executor.submit(scheduler.map, get_file, list(zip(rpaths, lpaths)))
+        cy = cycle(r"-\|/")
+        while not job.done():
+            print(f"Downloading data ({scheduler.limit} in flight) " + next(cy), end="\r")
+            sleep(0.1)
+        job.result()
 
     return sorted(lpaths)
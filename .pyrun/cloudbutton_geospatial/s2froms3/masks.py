@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cheap quality pre-pass based on the Scene Classification Map (SCL).
+
+The scene-level ``cloud_cover_le`` filter of ``get_scene_list`` is coarse.
+These helpers read the SCL band at overview resolution, which is a few
+hundred KB per tile, and compute cloud, shadow and no-data fractions per
+chunk or parcel window. Windows above the thresholds can then be dropped, or
+masked, before any expensive band read is scheduled.
+"""
+
+import math
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.windows import Window, bounds as window_bounds, from_bounds
+
+from .stack import BandStack, _href
+
+# SCL classes, see the Sentinel-2 L2A product specification
+SCL_NODATA = (0, 1)  # No data, saturated or defective
+SCL_SHADOW = (2, 3)  # Dark area pixels, cloud shadows
+SCL_CLOUD = (8, 9, 10)  # Cloud medium and high probability, thin cirrus
+
+
+class WindowQuality(NamedTuple):
+    """Fraction of cloud, shadow and no-data pixels of a window."""
+
+    cloud: float
+    shadow: float
+    nodata: float
+
+    @property
+    def invalid(self) -> float:
+        # Rounded so that a fully invalid window sums exactly 1
+        return round(self.cloud + self.shadow + self.nodata, 9)
+
+
+def _scl_path(scl: Union[str, BandStack]) -> str:
+    if isinstance(scl, BandStack):
+        if "SCL" not in scl.paths:
+            raise ValueError("The stack does not contain the SCL band")
+        return scl.paths["SCL"]
+    return scl
+
+
+def read_scl_overview(
+    scl: Union[str, BandStack], decimation: int = 8
+) -> Tuple[np.ndarray, Affine]:
+    """Read the SCL band decimated by `decimation`.
+
+    GDAL serves the read from the matching COG overview, so only a small part
+    of the file is transferred. Returns the array and its transform."""
+    with rasterio.open(_href(_scl_path(scl))) as src:
+        height = math.ceil(src.height / decimation)
+        width = math.ceil(src.width / decimation)
+        scl_arr = src.read(1, out_shape=(height, width))
+        transform = src.transform * Affine.scale(
+            src.width / width, src.height / height
+        )
+    return scl_arr, transform
+
+
+def scl_quality(scl_arr: np.ndarray) -> WindowQuality:
+    """Cloud, shadow and no-data fractions of an SCL array."""
+    if scl_arr.size == 0:
+        return WindowQuality(0.0, 0.0, 1.0)
+    size = float(scl_arr.size)
+    return WindowQuality(
+        cloud=np.isin(scl_arr, SCL_CLOUD).sum() / size,
+        shadow=np.isin(scl_arr, SCL_SHADOW).sum() / size,
+        nodata=np.isin(scl_arr, SCL_NODATA).sum() / size,
+    )
+
+
+def scl_mask(scl_arr: np.ndarray, classes: Optional[Iterable[int]] = None) -> np.ndarray:
+    """Boolean mask, True where the SCL class is cloud, shadow or no data
+    (or one of `classes`)."""
+    if classes is None:
+        classes = SCL_NODATA + SCL_SHADOW + SCL_CLOUD
+    return np.isin(scl_arr, tuple(classes))
+
+
+def window_quality(
+    scl: Union[str, BandStack],
+    windows: Sequence[Window],
+    transform: Optional[Affine] = None,
+    decimation: int = 8,
+) -> List[WindowQuality]:
+    """Quality of every window, computed from the SCL overview.
+
+    Parameters
+    ----------
+    scl: str or BandStack
+        Path of the SCL COG of a scene, or a ``BandStack`` containing it.
+    windows: array_like
+        Windows (chunks or parcel windows) to evaluate.
+    transform: Affine or None
+        Transform of the grid the windows refer to. Default value is the grid
+        of the stack when `scl` is a ``BandStack``.
+    decimation: int
+        Decimation factor applied to the SCL band. Default value is 8 (160 m
+        pixels for the 20 m SCL band).
+    """
+    if transform is None:
+        if not isinstance(scl, BandStack):
+            raise ValueError("`transform` is required when `scl` is a path")
+        transform = scl.transform
+    scl_arr, scl_transform = read_scl_overview(scl, decimation)
+    height, width = scl_arr.shape
+    quality = []
+    for window in windows:
+        ov_window = from_bounds(*window_bounds(window, transform), transform=scl_transform)
+        row0 = max(int(math.floor(ov_window.row_off)), 0)
+        col0 = max(int(math.floor(ov_window.col_off)), 0)
+        row1 = min(int(math.ceil(ov_window.row_off + ov_window.height)), height)
+        col1 = min(int(math.ceil(ov_window.col_off + ov_window.width)), width)
+        quality.append(scl_quality(scl_arr[row0:max(row0, row1), col0:max(col0, col1)]))
+    return quality
+
+
+def clear_windows(
+    scl: Union[str, BandStack],
+    windows: Sequence[Window],
+    transform: Optional[Affine] = None,
+    max_cloud: float = 0.5,
+    max_shadow: float = 1.0,
+    max_nodata: float = 0.5,
+    decimation: int = 8,
+) -> List[Window]:
+    """Keep only the windows whose cloud, shadow and no-data fractions are
+    lower or equal to the given thresholds. See ``window_quality``."""
+    quality = window_quality(scl, windows, transform, decimation)
+    return [
+        window
+        for window, q in zip(windows, quality)
+        if q.cloud <= max_cloud and q.shadow <= max_shadow and q.nodata <= max_nodata
+    ]
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Adaptive concurrency for network-bound transfers.
+
+The number of in-flight transfers is tuned while downloading: it grows while
+the measured throughput keeps improving and shrinks when throughput drops or
+transfers start failing (e.g. throttling).
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, NamedTuple, Optional, Sequence
+
+
+class Sample(NamedTuple):
+    """Measurements of one adjustment interval."""
+
+    time: float
+    limit: int
+    throughput: float
+    error_rate: float
+
+
+class AdaptiveScheduler:
+    """Run transfers with a concurrency limit adjusted to the measured
+    throughput and error rate.
+
+    Parameters
+    ----------
+    min_workers: int
+        Lower bound of in-flight transfers. Default value is 2.
+    max_workers: int
+        Upper bound of in-flight transfers. Also the size the HTTP connection
+        pool of the client must have. Default value is 64.
+    initial: int or None
+        Starting number of in-flight transfers. Default value is `min_workers`.
+    interval: float
+        Seconds between adjustments. Default value is 1.
+    max_error_rate: float
+        Error rate above which concurrency is halved. Default value is 0.05.
+    retries: int
+        Attempts per transfer before giving up. Default value is 3.
+    smoothing: float
+        Weight of the last interval in the exponentially weighted moving
+        average of the throughput. Default value is 0.3.
+    progressive: bool
+        If True, bytes are only counted through ``progress`` while transfers
+        run (e.g. as a boto3 ``Callback``) and not when they finish. Default
+        value is False.
+
+    Every transfer function must return the number of bytes it moved.
+    ``history`` keeps a ``Sample`` per interval, handy for benchmarking.
+    """
+
+    def __init__(
+        self,
+        min_workers: int = 2,
+        max_workers: int = 64,
+        initial: Optional[int] = None,
+        interval: float = 1.0,
+        max_error_rate: float = 0.05,
+        retries: int = 3,
+        smoothing: float = 0.3,
+        progressive: bool = False,
+    ):
+        if not 1 <= min_workers <= max_workers:
+            raise ValueError("`min_workers` has to be between 1 and `max_workers`")
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.limit = min(max(initial or min_workers, min_workers), max_workers)
+        self.interval = interval
+        self.max_error_rate = max_error_rate
+        self.retries = retries
+        self.smoothing = smoothing
+        self.progressive = progressive
+        self.history: List[Sample] = []
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._bytes = 0
+        self._ok = 0
+        self._errors = 0
+        self._last_adjust = time.monotonic()
+        self._throughput: Optional[float] = None
+        self._direction = 1
+        self._slow_start = True
+
+    def progress(self, size: int) -> None:
+        """Count bytes moved by a running transfer."""
+        with self._cond:
+            self._bytes += size
+
+    def _adjust(self) -> None:
+        """Hill-climbing step with a doubling start (AIMD on errors). Called
+        with the lock held."""
+        now = time.monotonic()
+        elapsed = now - self._last_adjust
+        if elapsed < self.interval:
+            return
+        attempts = self._ok + self._errors
+        active = attempts or self._bytes
+        throughput = self._bytes / elapsed
+        if active and self._throughput is not None:
+            # Smooth out lumpy completions before comparing
+            throughput = (
+                self.smoothing * throughput + (1 - self.smoothing) * self._throughput
+            )
+        error_rate = self._errors / attempts if attempts else 0.0
+        if error_rate > self.max_error_rate:
+            self.limit = max(self.min_workers, self.limit // 2)
+            self._direction = 1
+            self._slow_start = False
+        elif active:
+            if self._throughput is not None and throughput < self._throughput * 0.95:
+                # The last move made things worse: go the other way
+                self._direction = -self._direction
+                self._slow_start = False
+            # Double while throughput keeps growing, then probe one by one
+            step = self.limit if self._slow_start else self._direction
+            self.limit = min(
+                self.max_workers, max(self.min_workers, self.limit + step)
+            )
+        self.history.append(Sample(now, self.limit, throughput, error_rate))
+        if active:
+            self._throughput = throughput
+        self._bytes = self._ok = self._errors = 0
+        self._last_adjust = now
+        self._cond.notify_all()
+
+    def _run_one(self, func: Callable[..., int], args: Sequence[Any]) -> int:
+        try:
+            for attempt in range(self.retries):
+                try:
+                    size = func(*args)
+                except Exception:
+                    with self._cond:
+                        self._errors += 1
+                    if attempt == self.retries - 1:
+                        raise
+                    time.sleep(0.5 * 2 ** attempt)
+                else:
+                    with self._cond:
+                        self._ok += 1
+                        if not self.progressive:
+                            self._bytes += size or 0
+                    return size
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def map(self, func: Callable[..., int], items: Sequence[Sequence[Any]]) -> List[int]:
+        """Call ``func(*item)`` for every item and return the transferred
+        sizes. The first error is raised once every transfer has finished."""
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for item in items:
+                with self._cond:
+                    while self._in_flight >= self.limit:
+                        self._cond.wait(self.interval / 4)
+                        self._adjust()
+                    self._in_flight += 1
+                futures.append(executor.submit(self._run_one, func, item))
+            with self._cond:
+                while self._in_flight:
+                    self._cond.wait(self.interval / 4)
+                    self._adjust()
+        return [f.result() for f in futures]
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lazy multi-band access to Sentinel-2 COGs on a common grid.
+
+Sentinel-2 bands come at 10, 20 or 60 m (see ``Properties.describe``). A
+``BandStack`` exposes all the bands of a scene on a single target grid and
+resamples them window by window through ``WarpedVRT``, so no resampled copy
+of a whole tile is ever materialised.
+"""
+
+import os
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window, from_bounds
+
+from ..utils.crs import transform_bounds
+from .products import Properties
+
+S3_HTTP_ENDPOINT = "https://{bucket}.s3.us-west-2.amazonaws.com/{key}"
+
+
+def _band_name(path: str) -> str:
+    """Band name of a remote (``.../B04.tif``) or downloaded
+    (``..._B04.tif``) COG path."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return stem.rsplit("_", 1)[-1].upper()
+
+
+def _href(path: str) -> str:
+    """URL rasterio can open for a path returned by ``get_scene_list`` or
+    ``download_S2``."""
+    if os.path.exists(path) or "://" in path:
+        return path
+    bucket, key = path.split("/", 1)
+    return S3_HTTP_ENDPOINT.format(bucket=bucket, key=key)
+
+
+class BandStack:
+    """Lazy stack of the bands of one Sentinel-2 scene on a common grid.
+
+    Parameters
+    ----------
+    scene: array_like
+        One item of the list returned by ``get_scene_list`` (or the paths
+        returned by ``download_S2`` for a single scene).
+    resolution: int or None
+        Pixel size, in metres, of the target grid. Default value is the
+        finest resolution among the requested bands.
+    resampling: rasterio.enums.Resampling
+        Resampling used for bands whose native resolution differs from the
+        target one. Default value is nearest, which keeps SCL classes intact.
+
+    Datasets are opened on first use and reads are resampled per window, so
+    memory is bounded by the size of the requested window.
+    """
+
+    def __init__(
+        self,
+        scene: Sequence[str],
+        resolution: Optional[int] = None,
+        resampling: Resampling = Resampling.nearest,
+    ):
+        self.paths: Dict[str, str] = {_band_name(p): p for p in scene}
+        for band in self.paths:
+            if band not in [item.value for item in Properties]:
+                raise ValueError(f"{band} is not a valid product")
+        if resolution is None:
+            resolution = min(
+                Properties(band).describe()["resolution"] for band in self.paths
+            )
+        self.resolution = resolution
+        self.resampling = resampling
+        self._datasets: Dict[str, rasterio.io.DatasetReader] = {}
+        self._vrts: Dict[str, WarpedVRT] = {}
+        self._grid: Optional[Tuple] = None
+
+    @property
+    def bands(self) -> List[str]:
+        return list(self.paths)
+
+    def _dataset(self, band: str) -> rasterio.io.DatasetReader:
+        if band not in self._datasets:
+            self._datasets[band] = rasterio.open(_href(self.paths[band]))
+        return self._datasets[band]
+
+    def _get_grid(self) -> Tuple:
+        if self._grid is None:
+            # Every band covers the same tile footprint, so any of them
+            # defines the bounds of the target grid.
+            src = self._dataset(self.bands[0])
+            left, bottom, right, top = src.bounds
+            width = int(round((right - left) / self.resolution))
+            height = int(round((top - bottom) / self.resolution))
+            transform = from_origin(left, top, self.resolution, self.resolution)
+            self._grid = (src.crs, transform, width, height)
+        return self._grid
+
+    @property
+    def crs(self):
+        return self._get_grid()[0]
+
+    @property
+    def transform(self):
+        return self._get_grid()[1]
+
+    @property
+    def width(self) -> int:
+        return self._get_grid()[2]
+
+    @property
+    def height(self) -> int:
+        return self._get_grid()[3]
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return len(self.paths), self.height, self.width
+
+    def _reader(self, band: str) -> Union[rasterio.io.DatasetReader, WarpedVRT]:
+        src = self._dataset(band)
+        crs, transform, width, height = self._get_grid()
+        if src.transform == transform and (src.width, src.height) == (width, height):
+            return src
+        if band not in self._vrts:
+            self._vrts[band] = WarpedVRT(
+                src,
+                crs=crs,
+                transform=transform,
+                width=width,
+                height=height,
+                resampling=self.resampling,
+            )
+        return self._vrts[band]
+
+    def read_band(self, band: str, window: Optional[Window] = None) -> np.ndarray:
+        """Read a band (first raster band of its COG) on the target grid."""
+        band = band.upper()
+        if band not in self.paths:
+            raise ValueError(f"{band} is not part of this stack")
+        return self._reader(band).read(1, window=window)
+
+    def read(
+        self, window: Optional[Window] = None, bands: Optional[Iterable[str]] = None
+    ) -> np.ndarray:
+        """Read a window of several bands as a (bands, rows, cols) array.
+
+        All bands are cast to a common dtype so they can be stacked."""
+        bands = self.bands if bands is None else [b.upper() for b in bands]
+        arrays = [self.read_band(band, window) for band in bands]
+        dtype = np.result_type(*arrays)
+        return np.stack([arr.astype(dtype, copy=False) for arr in arrays])
+
+    def window_from_bounds(self, bounds: Sequence[float], crs=None) -> Window:
+        """Window of the target grid covering `bounds` (minx, miny, maxx,
+        maxy), given in `crs` (e.g. 'EPSG:4326') or in the grid CRS."""
+        if crs is not None:
+            bounds = transform_bounds(crs, self.crs, bounds)
+        window = from_bounds(*bounds, transform=self.transform)
+        return window.round_offsets().round_lengths()
+
+    def block_windows(self, size: int = 512) -> Iterator[Window]:
+        """Iterate over square windows covering the target grid."""
+        for row_off in range(0, self.height, size):
+            for col_off in range(0, self.width, size):
+                yield Window(
+                    col_off,
+                    row_off,
+                    min(size, self.width - col_off),
+                    min(size, self.height - row_off),
+                )
+
+    def close(self) -> None:
+        for vrt in self._vrts.values():
+            vrt.close()
+        for src in self._datasets.values():
+            src.close()
+        self._vrts = {}
+        self._datasets = {}
+
+    def __enter__(self) -> "BandStack":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __repr__(self) -> str:
+        return f"BandStack(bands={self.bands}, resolution={self.resolution})"
+
+
+def stacks_from_scene_list(
+    scenes: List[Sequence[str]],
+    resolution: Optional[int] = None,
+    resampling: Resampling = Resampling.nearest,
+) -> List[BandStack]:
+    """Build a ``BandStack`` for every scene returned by ``get_scene_list``."""
+    return [BandStack(scene, resolution, resampling) for scene in scenes]
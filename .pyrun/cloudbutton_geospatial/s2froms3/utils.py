@@ -6,10 +6,26 @@ This module contains some utils used mainly by the library itself.
 
 from typing import Union
 import datetime as dt
-from typing import Iterator, Tuple
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, Optional, Tuple
 
+import numpy as np
 import mgrs  # type: ignore
 
+# Offsets, in metres, from a tile to its neighbours. See `get_scene_list`.
+NEIGHBOURS = {
+    "N": (0, 150_000),
+    "NE": (150_000, 150_000),
+    "E": (150_000, 0),
+    "SE": (150_000, -150_000),
+    "S": (0, -150_000),
+    "SW": (-150_000, -150_000),
+    "W": (-150_000, 0),
+    "NW": (-150_000, 150_000),
+}
+
+_MGRS = mgrs.MGRS()
+
 
 def _iter_dates(
     start_date: Union[dt.date, dt.datetime], end_date: Union[dt.date, dt.datetime]
@@ -24,17 +40,83 @@ def _iter_dates(
         yield y, m + 1
 
 
+@lru_cache(maxsize=65536)
+def _lonlat_to_mgrs(lon: float, lat: float) -> Tuple[str, int, int]:
+    """Tile ID and metre position within the tile of a single location."""
+    coord = _MGRS.toMGRS(lat, lon, MGRSPrecision=5)
+    return coord[:-10], int(coord[-10:-5]), int(coord[-5:])
+
+
+def lonlat_to_tile(
+    lon: Union[float, Iterable[float]], lat: Union[float, Iterable[float]]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Map arrays of locations to MGRS tile IDs and in-tile positions.
+
+    Parameters
+    ----------
+    lon: float or array_like
+        Longitudes of the locations.
+    lat: float or array_like
+        Latitudes of the locations, same shape as `lon`.
+
+    Returns
+    -------
+    tuple
+        Three arrays with the shape of the input: the tile IDs (e.g.
+        '30SXG') and the easting and northing, in metres, of every location
+        measured from the south-west corner of its 100 km square.
+
+    Repeated locations are converted once, and conversions are cached
+    between calls.
+    """
+    lon, lat = np.broadcast_arrays(
+        np.asarray(lon, dtype="float64"), np.asarray(lat, dtype="float64")
+    )
+    coords, inverse = np.unique(
+        np.stack([lon.ravel(), lat.ravel()], axis=1), axis=0, return_inverse=True
+    )
+    inverse = inverse.reshape(-1)
+    converted = [_lonlat_to_mgrs(float(x), float(y)) for x, y in coords]
+    tiles = np.array([c[0] for c in converted], dtype="U5")[inverse]
+    x = np.array([c[1] for c in converted], dtype="int32")[inverse]
+    y = np.array([c[2] for c in converted], dtype="int32")[inverse]
+    return tiles.reshape(lon.shape), x.reshape(lon.shape), y.reshape(lon.shape)
+
+
+@lru_cache(maxsize=4096)
+def _neighbour_tile(tile: str, direction: str) -> str:
+    z, hem, x, y = _MGRS.MGRSToUTM(tile)
+    dx, dy = NEIGHBOURS[direction]
+    return _MGRS.UTMToMGRS(z, hem, x + dx, y + dy, MGRSPrecision=0)
+
+
+def neighbour_tiles(
+    tile: str, directions: Optional[Iterable[str]] = None
+) -> Dict[str, str]:
+    """Return the tiles around `tile` as a {direction: tile ID} dict.
+
+    Valid directions are 'N', 'NE', 'E', 'SE', 'S', 'SW', 'W' and 'NW'.
+    Default value is all of them."""
+    if directions is None:
+        directions = NEIGHBOURS.keys()
+    neighbours = {}
+    for direction in directions:
+        direction = direction.upper()
+        if direction not in NEIGHBOURS:
+            raise ValueError(f'"{direction}" is not a valid direction')
+        neighbours[direction] = _neighbour_tile(tile, direction)
+    return neighbours
+
+
 def point_in_tile(lon: Union[int, float], lat: Union[int, float]) -> str:
     """Function printing where is the (lon, lat) location within the tile.
 
     The idea of this function is to show you if the location is very close
     to a border/corner so you wonder if you would need other COGs in the
     surroundings."""
-    m = mgrs.MGRS()
-    _, _, x0, y0 = m.MGRSToUTM(m.toMGRS(lat, lon, MGRSPrecision=0))
-    _, _, x10, y10 = m.MGRSToUTM(m.toMGRS(lat, lon, MGRSPrecision=1))
-    x = (x10 - x0) / 10000
-    y = 10 - (y10 - y0) / 10000
+    _, x_m, y_m = _lonlat_to_mgrs(float(lon), float(lat))
+    x = x_m // 10000
+    y = 10 - y_m // 10000
     res = "\n"
     for j in range(11):
         for i in range(11):
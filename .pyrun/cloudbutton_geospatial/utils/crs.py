@@ -0,0 +1,78 @@
+from functools import lru_cache
+
+import numpy as np
+from pyproj import CRS, Transformer
+from shapely.ops import transform as shapely_transform
+
+WGS84 = 'EPSG:4326'
+
+
+def _crs_key(crs):
+    """
+    Hashable key for anything pyproj understands (EPSG code, string, dict,
+    rasterio or pyproj CRS).
+    """
+    if hasattr(crs, 'to_wkt'):
+        return crs.to_wkt()
+    if isinstance(crs, dict):
+        return tuple(sorted(crs.items()))
+    return crs
+
+
+@lru_cache(maxsize=64)
+def _get_transformer(src_key, dst_key):
+    src = CRS.from_user_input(dict(src_key) if isinstance(src_key, tuple) else src_key)
+    dst = CRS.from_user_input(dict(dst_key) if isinstance(dst_key, tuple) else dst_key)
+    if src == dst:
+        return None
+    return Transformer.from_crs(src, dst, always_xy=True)
+
+
+def get_transformer(src_crs, dst_crs):
+    """
+    Cached (x, y) order transformer between two CRSs, or None when they are
+    the same CRS.
+    """
+    return _get_transformer(_crs_key(src_crs), _crs_key(dst_crs))
+
+
+def transform_coords(src_crs, dst_crs, x, y):
+    """
+    Transform scalars or arrays of coordinates in one call.
+    """
+    transformer = get_transformer(src_crs, dst_crs)
+    if transformer is None:
+        return x, y
+    if np.isscalar(x) and np.isscalar(y):
+        return transformer.transform(x, y)
+    return transformer.transform(np.asarray(x, dtype='float64'), np.asarray(y, dtype='float64'))
+
+
+def transform_bounds(src_crs, dst_crs, bounds):
+    """
+    Bounds (minx, miny, maxx, maxy) covering the reprojected bounds.
+    """
+    transformer = get_transformer(src_crs, dst_crs)
+    if transformer is None:
+        return tuple(bounds)
+    return transformer.transform_bounds(*bounds)
+
+
+def transform_geometry(src_crs, dst_crs, geometry):
+    """
+    Reproject a shapely geometry.
+    """
+    transformer = get_transformer(src_crs, dst_crs)
+    if transformer is None:
+        return geometry
+    return shapely_transform(transformer.transform, geometry)
+
+
+def transform_geometries(src_crs, dst_crs, geometries):
+    """
+    Reproject a collection of shapely geometries with a single transformer.
+    """
+    transformer = get_transformer(src_crs, dst_crs)
+    if transformer is None:
+        return list(geometries)
+    return [shapely_transform(transformer.transform, geometry) for geometry in geometries]
@@ -0,0 +1,54 @@
+import numpy as np
+from scipy.spatial import cKDTree, distance_matrix
+
+
+class IDWInterpolator:
+    """
+    Inverse Distance Weighting interpolation over a grid of pixels.
+
+    The weights only depend on the station and pixel positions, so they are
+    computed once and reused for any number of dates: interpolating an extra
+    day is a single matrix product. With neighbours, only the nearest
+    stations of each pixel (found with a KD-tree) are weighted.
+    """
+    def __init__(self, station_pixels, shape, offset=(0, 0), neighbours=None):
+        self.shape = tuple(shape)
+        station_pixels = np.asarray(station_pixels, dtype='float64').reshape(-1, 2)
+        tile_pixels = np.indices(self.shape).reshape(2, -1).T + offset
+        self.n_stations = len(station_pixels)
+        if neighbours is None or neighbours >= self.n_stations:
+            self.neighbours = None
+            dist = distance_matrix(tile_pixels, station_pixels)
+        else:
+            self.neighbours = neighbours
+            dist, self.indices = cKDTree(station_pixels).query(tile_pixels, k=neighbours)
+            dist = dist.reshape(len(tile_pixels), neighbours)
+            self.indices = self.indices.reshape(len(tile_pixels), neighbours)
+        with np.errstate(divide='ignore'):
+            weights = np.where(dist == 0, np.finfo('float32').max, 1.0 / dist)
+        weights /= weights.sum(axis=1, keepdims=True)
+        self.weights = weights
+
+    def _apply(self, values):
+        if self.neighbours is None:
+            return self.weights @ values
+        return np.einsum('pk,pk...->p...', self.weights, values[self.indices])
+
+    def __call__(self, values):
+        """
+        Interpolate station values of shape (stations,) into an array of the
+        grid shape, or (stations, days) into a (days, *shape) stack. Missing
+        values (NaN) are left out and the weights of the rest renormalized.
+        """
+        values = np.asarray(values, dtype='float64')
+        if values.shape[0] != self.n_stations:
+            raise ValueError(f'Expected {self.n_stations} station values, got {values.shape[0]}')
+        missing = np.isnan(values)
+        if missing.any():
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result = self._apply(np.where(missing, 0, values)) / self._apply((~missing).astype('float64'))
+        else:
+            result = self._apply(values)
+        if values.ndim == 1:
+            return result.reshape(self.shape).astype('float32')
+        return result.T.reshape((values.shape[1],) + self.shape).astype('float32')